@@ -0,0 +1,162 @@
+import heapq
+import asyncio
+from aiobbox.exceptions import ServiceError
+
+'''
+admission control of service methods, a gate admits at most limit
+calls at a time, the waiting calls are admitted by priority class
+then by arrival order
+'''
+
+# the error code of calls rejected by a busy box,
+# clients retry them on another box
+BUSY_ERROR = 'box busy'
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+priority_names = {
+    'high': PRIORITY_HIGH,
+    'normal': PRIORITY_NORMAL,
+    'low': PRIORITY_LOW
+}
+
+def parse_priority(priority):
+    if priority is None:
+        return PRIORITY_NORMAL
+    if isinstance(priority, str):
+        return priority_names[priority]
+    return int(priority)
+
+class Gate:
+    def __init__(self, limit=None, max_queue=None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiters = []   # heap of [priority, seq, fut]
+        self.seq = 0
+
+    @property
+    def queued(self):
+        return sum(1 for _, _, fut in self.waiters
+                   if not fut.done())
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if self.limit is None:
+            self.running += 1
+            return
+        if self.running < self.limit and not self.waiters:
+            self.running += 1
+            return
+        if (self.max_queue is not None
+            and self.queued >= self.max_queue):
+            raise ServiceError(BUSY_ERROR, 'too many calls waiting')
+
+        fut = asyncio.get_event_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.waiters, [priority, self.seq, fut])
+        try:
+            # the slot is handed over by release()
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, fut = heapq.heappop(self.waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.running -= 1
+
+_box_gate = None
+
+def get_box_gate():
+    '''
+    the gate of all method calls in the box, it is
+    unlimited unless box config max_running is set
+    '''
+    global _box_gate
+    if _box_gate is None:
+        from aiobbox.cluster import get_box
+        box = get_box()
+        limit = None
+        if box.started:
+            limit = box.get_box_config('max_running')
+        _box_gate = Gate(limit=limit)
+    return _box_gate
+
+# the error code of calls shed by an overloaded box
+OVERLOAD_ERROR = 'box overloaded'
+
+# the defaults of box config shed_loop_lag and shed_max_inflight
+SHED_LOOP_LAG = 0.5
+SHED_MAX_INFLIGHT = None
+
+LAG_SAMPLE_SECS = 0.1
+LAG_DECAY = 0.3
+
+class LoadShedder:
+    '''
+    reject new calls early once the event loop lags or too many
+    calls are in flight, the state is reported in box_info so
+    that clients steer away from the box
+    '''
+    def __init__(self):
+        self.loop_lag = 0.0
+        self.inflight = 0
+        self.max_lag = SHED_LOOP_LAG
+        self.max_inflight = SHED_MAX_INFLIGHT
+        self.cont = False
+        # called with every lag sample if set
+        self.on_lag = None
+
+    def configure(self, box):
+        self.max_lag = box.get_box_config(
+            'shed_loop_lag', SHED_LOOP_LAG)
+        self.max_inflight = box.get_box_config(
+            'shed_max_inflight', SHED_MAX_INFLIGHT)
+
+    def start(self):
+        if not self.cont:
+            self.cont = True
+            asyncio.ensure_future(self.sample_lag())
+
+    def stop(self):
+        self.cont = False
+
+    async def sample_lag(self):
+        loop = asyncio.get_event_loop()
+        while self.cont:
+            start_time = loop.time()
+            await asyncio.sleep(LAG_SAMPLE_SECS)
+            lag = max(0.0, loop.time() - start_time - LAG_SAMPLE_SECS)
+            self.loop_lag += LAG_DECAY * (lag - self.loop_lag)
+            if self.on_lag is not None:
+                self.on_lag(lag)
+
+    @property
+    def overloaded(self):
+        if self.max_lag and self.loop_lag > self.max_lag:
+            return True
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            return True
+        return False
+
+    def check(self):
+        if self.overloaded:
+            raise ServiceError(OVERLOAD_ERROR,
+                               'loop lag {:.3f}s, {} calls in flight'.format(
+                                   self.loop_lag, self.inflight))
+
+    def load_info(self):
+        return {
+            'overloaded': self.overloaded,
+            'loop_lag': round(self.loop_lag, 3),
+            'inflight': self.inflight
+        }
+
+load_shedder = LoadShedder()
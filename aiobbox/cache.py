@@ -0,0 +1,86 @@
+import copy
+import time
+from collections import OrderedDict
+from aiobbox.metrics import add_metrics
+
+'''
+bounded LRU caches of method results with TTL, values are
+copied in and out so callers cannot change cached results
+'''
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1024
+
+_caches = []
+
+class ResultCache:
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=None, endpoint=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.endpoint = endpoint
+        self.entries = OrderedDict()   # key => (expire_at, size, value)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _caches.append(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        return (hit, value)
+        '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, copy.deepcopy(entry[2])
+            self.remove(key)
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value, size=0, ttl=None):
+        self.remove(key)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        expire_at = time.time() + (ttl or self.ttl)
+        self.entries[key] = (expire_at, size, copy.deepcopy(value))
+        self.nbytes += size
+        while (len(self.entries) > self.max_entries
+               or (self.max_bytes and self.nbytes > self.max_bytes)):
+            _, (_, esize, _) = self.entries.popitem(last=False)
+            self.nbytes -= esize
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+class CacheEventCount:
+    name = 'rpc_cache_events'
+    help = 'Result cache hits, misses and evictions'
+    type = 'counter'
+
+    async def collect(self):
+        arr = []
+        for cache in _caches:
+            if not cache.endpoint:
+                continue
+            for event, v in (('hit', cache.hits),
+                             ('miss', cache.misses),
+                             ('eviction', cache.evictions)):
+                arr.append(({'endpoint': cache.endpoint,
+                             'event': event}, v))
+        return arr
+
+add_metrics(CacheEventCount())
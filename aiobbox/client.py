@@ -1,21 +1,42 @@
 import logging
+import copy
+import time
 import asyncio
 import random
 import aiohttp
-from aiochannel import Channel
-from aiochannel.errors import ChannelClosed
 from urllib.parse import urljoin
 import json
 import uuid
-from aiobbox.cluster import get_cluster
-from aiobbox.exceptions import ConnectionError, Retry
+from collections import defaultdict
+from aiobbox.cluster import get_cluster, get_sharedconfig
+from aiobbox.exceptions import ConnectionError, Retry, ServiceError
 from aiobbox.utils import get_cert_ssl_context
-from aiobbox.server import has_service, Request
+from aiobbox.server import has_service, Request, BUSY_ERROR
+from aiobbox.server import get_deadline, OVERLOAD_ERROR
+from aiobbox.server import WS_MAX_INFLIGHT, BATCH_TOO_LARGE
+from aiobbox.codec import json_codec, send_ws
+from aiobbox.singleflight import SingleFlight, params_key
+from aiobbox.cache import ResultCache
+from aiobbox.codec import client_ws_protocols, get_codec_by_protocol
+from aiobbox.codec import get_codec
 
 logger = logging.getLogger('bbox')
 
 DEFAULT_TIMEOUT_SECS = 5
 
+# smoothing factor of the latency EWMA
+LATENCY_DECAY = 0.3
+
+# chunks a stream may send ahead of the consumer
+STREAM_WINDOW = 64
+
+# open another connection to a box once every connection
+# has that many outstanding requests
+CONNECTION_INFLIGHT = 16
+
+# extra connections idle for that long are closed
+CONNECTION_IDLE_SECS = 30
+
 try:
     import selectors
 except ImportError:
@@ -54,9 +75,10 @@ class HttpClient:
         self.session = None
 
 class WebSocketClient:
-    def __init__(self, connect):
+    def __init__(self, connect, codec=None):
         c = get_cluster()
         box = c.boxes[connect]
+        self.bind = connect
         self.ssl_prefix = box['ssl']
         if self.ssl_prefix:
             self.url_prefix = 'wss://' + connect
@@ -67,21 +89,59 @@ class WebSocketClient:
         conn = aiohttp.TCPConnector(ssl_context=ssl_context)
         self.session = aiohttp.ClientSession(connector=conn)
         self.waiters = {}
+        # req_id => queue of stream messages
+        self.streams = {}
         self.ws = None
         self.notify_channel = None
         self.cont = True
 
+        # the preferred codec name, the actual codec is
+        # negotiated as websocket subprotocol
+        self.codec_name = codec
+        self.codec = json_codec
+
+        # load stats used by the dispatch policies
+        self.inflight = 0
+        self.latency = None
+        self.last_active = time.time()
+
+        # called when the connection is opened or closed
+        self.state_listener = None
+
         asyncio.ensure_future(self.connect_wait())
 
     @property
     def connected(self):
-        return not not self.ws
+        return self.cont and not not self.ws
+
+    def state_changed(self):
+        if self.state_listener:
+            self.state_listener(self)
+
+    def record_latency(self, elapsed):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += LATENCY_DECAY * (elapsed - self.latency)
+
+    def load(self):
+        '''
+        the expected cost of sending one more request
+        '''
+        return (self.inflight + 1) * (self.latency or 0.001)
 
     def close(self):
+        '''
+        stop the client, the receive loop closes the websocket
+        and the session
+        '''
+        if not self.cont:
+            return
         self.cont = False
         if self.ws:
-            self.ws.close()
-            self.ws = None
+            self.state_changed()
+            # wakes up the receive loop with a closing message
+            asyncio.ensure_future(self.ws.close())
 
     async def connect(self):
         if self.ws:
@@ -91,8 +151,12 @@ class WebSocketClient:
 
         url = self.url_prefix + '/jsonrpc/2.0/ws'
         try:
-            ws = await self.session.ws_connect(url, autoclose=False, autoping=False, heartbeat=1.0)
+            ws = await self.session.ws_connect(
+                url, autoclose=False, autoping=False, heartbeat=1.0,
+                protocols=client_ws_protocols(self.codec_name))
+            self.codec = get_codec_by_protocol(ws.protocol)
             self.ws = ws
+            self.state_changed()
         except OSError:
             logger.warn('OSError, connect to %s failed', url)
 
@@ -109,27 +173,150 @@ class WebSocketClient:
             'method': method,
             'params': params
             }
+        if timeout is not None:
+            # a relative budget, the clocks of hosts may differ
+            payload['timeout'] = timeout
+
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters[req_id] = fut
+        self.inflight += 1
+        start_time = time.time()
+        self.last_active = start_time
+        try:
+            await send_ws(self.ws, self.codec, payload)
+            r = await asyncio.wait_for(fut, timeout=timeout)
+            self.record_latency(time.time() - start_time)
+            return r
+        except asyncio.TimeoutError:
+            self.record_latency(time.time() - start_time)
+            raise
+        finally:
+            # remove the waiter on timeout or cancel
+            self.waiters.pop(req_id, None)
+            self.inflight -= 1
+
+    async def request_many(self, calls, timeout=DEFAULT_TIMEOUT_SECS):
+        '''
+        send calls of (srv, method, params, req_id) in one batch,
+        return the responses in the order of calls
+        '''
+        if not self.connected:
+            raise ConnectionError('websocket closed')
 
-        channel = Channel(1)
-        self.waiters[req_id] = channel
+        loop = asyncio.get_event_loop()
+        payload = []
+        futs = []
+        for srv, method, params, req_id in calls:
+            item = {
+                'jsonrpc': '2.0',
+                'id': req_id,
+                'method': srv + '::' + method,
+                'params': params
+                }
+            if timeout is not None:
+                item['timeout'] = timeout
+            payload.append(item)
+            fut = loop.create_future()
+            self.waiters[req_id] = fut
+            futs.append(fut)
+        self.inflight += len(futs)
+        start_time = time.time()
+        self.last_active = start_time
         try:
-            await self.ws.send_json(payload)
+            await send_ws(self.ws, self.codec, payload)
             r = await asyncio.wait_for(
-                channel.get(),
+                asyncio.gather(*futs),
                 timeout=timeout)
+            self.record_latency(time.time() - start_time)
             return r
-        except ChannelClosed:
-            raise ConnectionError(
-                'websocket closed on sending req')
+        except asyncio.TimeoutError:
+            self.record_latency(time.time() - start_time)
+            raise
+        finally:
+            for item in payload:
+                self.waiters.pop(item['id'], None)
+            self.inflight -= len(futs)
+
+    async def stream(self, srv, method, *params, req_id=None, timeout=DEFAULT_TIMEOUT_SECS):
+        '''
+        yield the items of a streaming method,
+        timeout bounds the wait for each item
+        '''
+        if not self.connected:
+            raise ConnectionError('websocket closed')
+
+        if not req_id:
+            req_id = uuid.uuid4().hex
+        payload = {
+            'jsonrpc': '2.0',
+            'id': req_id,
+            'method': srv + '::' + method,
+            'params': params,
+            # the box sends chunks only as far as the credit goes,
+            # so at most STREAM_WINDOW chunks wait in the queue
+            'credit': STREAM_WINDOW
+            }
+        deadline = get_deadline()
+        if deadline is not None:
+            payload['timeout'] = deadline - time.time()
+
+        queue = asyncio.Queue()
+        self.streams[req_id] = queue
+        self.inflight += 1
+        self.last_active = time.time()
+        ended = False
+        consumed = 0
+        try:
+            await send_ws(self.ws, self.codec, payload)
+            while True:
+                data = await asyncio.wait_for(queue.get(), timeout=timeout)
+                if isinstance(data, Exception):
+                    ended = True
+                    raise data
+                if 'chunk' in data:
+                    consumed += 1
+                    if consumed >= STREAM_WINDOW // 2:
+                        self.send_stream_control(req_id, credit=consumed)
+                        consumed = 0
+                    yield data['chunk']
+                    continue
+                ended = True
+                raise_stream_error(data)
+                if not data.get('stream_end'):
+                    # a non-streaming method, yield its whole result
+                    result = data.get('result')
+                    for item in (result or ()):
+                        yield item
+                return
         finally:
-            channel.close()
+            self.streams.pop(req_id, None)
+            self.inflight -= 1
+            if not ended:
+                # the consumer stopped early or timed out
+                self.send_stream_control(req_id, cancel=True)
+
+    def send_stream_control(self, req_id, **kw):
+        if self.connected:
+            msg = dict(kw, jsonrpc='2.0', id=req_id)
+            asyncio.ensure_future(send_ws(self.ws, self.codec, msg))
 
     async def onclosed(self):
         self.ws = None
-        for req_id, channel in self.waiters.items():
-            channel.close()
-        self.session.close()
+        # the receive loop ends, the pool replaces this client
+        self.cont = False
+        self.state_changed()
+        waiters = self.waiters
         self.waiters = {}
+        for fut in waiters.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError(
+                    'websocket closed on sending req'))
+        streams = self.streams
+        self.streams = {}
+        for queue in streams.values():
+            queue.put_nowait(ConnectionError(
+                'websocket closed on streaming'))
+        await self.session.close()
 
     async def connect_wait(self):
         while self.cont:
@@ -139,10 +326,9 @@ class WebSocketClient:
                 await asyncio.sleep(1.0)
                 continue
             msg = await self.ws.receive()
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                data = json.loads(msg.data)
-            elif msg.type == aiohttp.WSMsgType.BINARY:
-                continue
+            if msg.type in (aiohttp.WSMsgType.TEXT,
+                            aiohttp.WSMsgType.BINARY):
+                data = self.codec.loads(msg.data)
             elif msg.type == aiohttp.WSMsgType.PING:
                 self.ws.pong()
                 continue
@@ -156,18 +342,189 @@ class WebSocketClient:
                 return await self.onclosed()
             elif msg.type == aiohttp.WSMsgType.CLOSED:
                 logger.debug('websocket closed')
-                return
+                return await self.onclosed()
 
-            req_id = data.get('id')
-            if req_id:
-                channel = self.waiters.get(req_id)
-                if channel:
-                    del self.waiters[req_id]
-                    await channel.put(data)
-                else:
-                    logger.warn('Cannot find channel by id ', req_id)
+            elif msg.type == aiohttp.WSMsgType.CLOSING:
+                logger.debug('websocket closing')
+                return await self.onclosed()
+
+            if isinstance(data, list):
+                # response of a batch request
+                for item in data:
+                    self.dispatch(item)
             else:
-                logger.debug('no reqid seems a notify', data)
+                self.dispatch(data)
+
+        # closed before or while connecting
+        if self.ws:
+            await self.ws.close()
+        await self.onclosed()
+
+    def dispatch(self, data):
+        req_id = data.get('id')
+        if req_id:
+            queue = self.streams.get(req_id)
+            if queue is not None:
+                queue.put_nowait(data)
+                return
+            fut = self.waiters.pop(req_id, None)
+            if fut is None:
+                if 'chunk' in data or data.get('stream_end'):
+                    # a late message of a cancelled stream
+                    return
+                logger.warn('Cannot find waiter by id %s', req_id)
+            elif not fut.done():
+                fut.set_result(data)
+        else:
+            logger.debug('no reqid seems a notify %s', data)
+
+class BoxClient:
+    '''
+    websocket connections to one box, requests are striped over
+    the connections by outstanding count. Connections are opened
+    up to max_connections under load and closed when idle
+    '''
+    def __init__(self, connect, codec=None, max_connections=1):
+        self.bind = connect
+        self.codec_name = codec
+        self.max_connections = max(1, max_connections)
+        self.conns = []
+        self.cont = True
+        self.state_listener = None
+        # the batch size the box takes, learned from its
+        # batch too large errors, None if not known
+        self.max_batch = None
+        self.add_connection()
+
+    def add_connection(self):
+        conn = WebSocketClient(self.bind, codec=self.codec_name)
+        conn.state_listener = self.conn_state_changed
+        self.conns.append(conn)
+
+    def conn_state_changed(self, conn):
+        if not conn.cont and conn in self.conns:
+            self.conns.remove(conn)
+            if not self.conns:
+                # all connections are lost, the pool replaces me
+                self.cont = False
+        if self.state_listener:
+            self.state_listener(self)
+
+    @property
+    def connected(self):
+        return any(conn.connected for conn in self.conns)
+
+    @property
+    def inflight(self):
+        return sum(conn.inflight for conn in self.conns)
+
+    @property
+    def waiters(self):
+        return sum(len(conn.waiters) for conn in self.conns)
+
+    def load(self):
+        latencies = [conn.latency for conn in self.conns
+                     if conn.latency is not None]
+        if latencies:
+            latency = sum(latencies) / len(latencies)
+        else:
+            latency = 0.001
+        return (self.inflight + 1) * latency
+
+    def close(self):
+        self.cont = False
+        for conn in self.conns:
+            conn.state_listener = None
+            conn.close()
+        self.conns = []
+
+    def close_idle(self):
+        now = time.time()
+        for conn in self.conns[1:]:
+            if (conn.inflight == 0
+                and now - conn.last_active > CONNECTION_IDLE_SECS):
+                logger.debug('close idle connection to %s', self.bind)
+                self.conns.remove(conn)
+                conn.state_listener = None
+                conn.close()
+
+    def pick(self):
+        if len(self.conns) > 1:
+            self.close_idle()
+        conn = None
+        for c in self.conns:
+            if c.connected and (conn is None
+                                or c.inflight < conn.inflight):
+                conn = c
+        if conn is None:
+            raise ConnectionError('websocket closed')
+        if (conn.inflight >= CONNECTION_INFLIGHT
+            and len(self.conns) < self.max_connections):
+            # it takes effect once connected
+            self.add_connection()
+        return conn
+
+    async def request(self, *args, **kw):
+        return await self.pick().request(*args, **kw)
+
+    async def request_many(self, *args, **kw):
+        return await self.pick().request_many(*args, **kw)
+
+    async def stream(self, *args, **kw):
+        async for item in self.pick().stream(*args, **kw):
+            yield item
+
+def inherit_timeout(timeout):
+    '''
+    bound timeout by the deadline of the request being served
+    '''
+    deadline = get_deadline()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise asyncio.TimeoutError()
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+def local_request(srv, method, params, req_id):
+    body = {
+        'id': req_id,
+        'params': params,
+        'method': '{}::{}'.format(srv, method)
+    }
+    deadline = get_deadline()
+    if deadline is not None:
+        body['timeout'] = deadline - time.time()
+    return Request(body)
+
+def raise_stream_error(resp):
+    error = resp.get('error')
+    if error:
+        if isinstance(error, dict):
+            raise ServiceError(error.get('code', 'error'),
+                               error.get('message'))
+        raise ServiceError('error', str(error))
+
+def error_response(req_id, code, message):
+    '''
+    a local error response of a call in request_many
+    '''
+    return {'jsonrpc': '2.0',
+            'id': req_id,
+            'error': {'code': code,
+                      'message': message}}
+
+def is_busy(resp):
+    error = resp.get('error')
+    return (isinstance(error, dict)
+            and error.get('code') in (BUSY_ERROR, OVERLOAD_ERROR))
+
+def is_batch_too_large(resp):
+    error = resp.get('error')
+    return (isinstance(error, dict)
+            and error.get('code') == BATCH_TOO_LARGE)
 
 class MethodRef:
     def __init__(self, name, srv_ref):
@@ -181,6 +538,13 @@ class MethodRef:
             *params,
             **kw)
 
+    def stream(self, *params, **kw):
+        return self.srv_ref.pool.stream(
+            self.srv_ref.name,
+            self.name,
+            *params,
+            **kw)
+
 class ServiceRef:
     def __init__(self, srv_name, pool):
         self.name = srv_name
@@ -192,25 +556,56 @@ class ServiceRef:
 class FullConnectPool:
     FIRST = 1
     RANDOM = 2
+    # pick the client with the least outstanding requests
+    LEAST_OUTSTANDING = 3
+    # power of two choices, pick the less loaded of two random clients
+    P2C = 4
+
+    policy_names = {
+        'first': FIRST,
+        'random': RANDOM,
+        'least': LEAST_OUTSTANDING,
+        'p2c': P2C
+    }
 
     def __init__(self):
         self.pool = {}
         self.policy = self.FIRST
         self.max_concurrency = 10
+        # preferred wire codec, None for JSON
+        self.codec = None
+        # calls sent to a box in one batch of request_many,
+        # smaller batches are sent to boxes with lower limits
+        self.max_batch = WS_MAX_INFLIGHT
 
-    async def ensure_clients(self, srv):
-        if has_service(srv):
-            return
+        # srv => (version, connected clients in route order),
+        # rebuilt when the route or a connection state changes
+        self.ready = {}
+        self.conn_version = 0
+
+        # in-flight coalesced requests
+        self.flights = SingleFlight()
+
+        # results of methods hinted cacheable by boxes,
+        # set result_cache to None to disable
+        self.result_cache = ResultCache(max_entries=4096)
+        self.cacheable = set()
+
+    def client_state_changed(self, client):
+        self.conn_version += 1
+
+    def sync_clients(self, srv):
         agent = get_cluster()
         boxes = agent.route[srv]
 
-        # connect at most n concurrent connections
+        # connect at most n concurrent connections, keyed
+        # requests connect the owner boxes on demand
         for bind in sorted(boxes)[:self.max_concurrency]:
-            if bind not in self.pool:
-                # add box to pool
-                box = agent.boxes[bind]
-                client = WebSocketClient(bind)
-                self.pool[bind] = client
+            client = self.pool.get(bind)
+            if client is None or not client.cont:
+                self.add_client(bind)
+            else:
+                client.max_connections = self.get_connections_per_box(bind)
 
         for bind, client in list(self.pool.items()):
             if bind not in agent.boxes:
@@ -219,39 +614,137 @@ class FullConnectPool:
                 client.close()
                 del self.pool[bind]
 
+    def add_client(self, bind):
+        client = BoxClient(bind, codec=self.codec,
+                           max_connections=self.get_connections_per_box(bind))
+        client.state_listener = self.client_state_changed
+        self.pool[bind] = client
+        return client
+
+    def get_connections_per_box(self, bind):
+        box = get_cluster().boxes.get(bind) or {}
+        n = get_sharedconfig().get_chain(
+            ['box.{}'.format(box.get('boxid')),
+             'box.default'],
+            'connections_per_box',
+            default=1)
+        return max(1, int(n))
+
+    def get_ready_clients(self, srv):
+        agent = get_cluster()
+        version = (agent.route_version, self.conn_version)
+        entry = self.ready.get(srv)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        self.sync_clients(srv)
+        clients = []
+        overloaded = []
+        for bind in agent.route[srv]:
+            client = self.pool.get(bind)
+            if client and client.connected:
+                load = agent.boxes[bind].get('load') or {}
+                if load.get('overloaded'):
+                    overloaded.append(client)
+                else:
+                    clients.append(client)
+        # steer away from overloaded boxes unless all are
+        clients = clients or overloaded
+        # sync_clients may close clients and bump the version
+        version = (agent.route_version, self.conn_version)
+        self.ready[srv] = (version, clients)
+        return clients
+
+    async def ensure_clients(self, srv):
+        if has_service(srv):
+            return
+
         for _ in range(30):
-            c = self.get_client(srv, policy=self.FIRST)
-            if c:
+            if self.get_ready_clients(srv):
                 return
             await asyncio.sleep(0.01)
 
-    def get_client_count(self, srv):
-        cc = get_cluster()
-        cnt = 0
-        for bind in cc.route[srv]:
+    async def ensure_key_client(self, srv, route_key, exclude=None):
+        '''
+        connect the box owning route_key if it is not in the pool
+        '''
+        ring = get_cluster().get_ring(srv)
+        for bind in ring.iter_nodes(str(route_key)):
+            if exclude and bind in exclude:
+                continue
             client = self.pool.get(bind)
-            if client and client.connected:
-                cnt += 1
-        return cnt
+            if client is None or not client.cont:
+                client = self.add_client(bind)
+            for _ in range(30):
+                if client.connected:
+                    return
+                await asyncio.sleep(0.01)
+            return
+
+    def get_client_count(self, srv):
+        return len(self.get_ready_clients(srv))
 
-    def get_client(self, srv, policy=None, boxid=None):
+    def get_client(self, srv, policy=None, boxid=None, route_key=None, exclude=None):
         policy = policy or self.policy
-        clients = []
-        cc = get_cluster()
-        for bind in cc.route[srv]:
+        if route_key is not None and not boxid:
+            return self.get_client_by_key(srv, route_key, exclude)
+        clients = self.get_ready_clients(srv)
+        if exclude:
+            # prefer boxes not tried yet
+            clients = ([c for c in clients if c.bind not in exclude]
+                       or clients)
+        if boxid:
+            cc = get_cluster()
+            clients = [c for c in clients
+                       if cc.boxes.get(c.bind, {}).get('boxid') == boxid]
+        if not clients:
+            return None
+        if policy == self.FIRST:
+            return clients[0]
+        return self.choose_client(clients, policy)
+
+    def get_client_by_key(self, srv, route_key, exclude=None):
+        '''
+        pick the box owning route_key on the hash ring, fall back
+        to the next boxes clockwise if not connected or excluded
+        '''
+        ring = get_cluster().get_ring(srv)
+        excluded = None
+        for bind in ring.iter_nodes(str(route_key)):
             client = self.pool.get(bind)
             if client and client.connected:
-                if boxid:
-                    box = cc.boxes.get(bind)
-                    if box.boxid != boxid:
-                        continue
-                if policy == self.FIRST:
+                if not exclude or bind not in exclude:
                     return client
-                else:
-                    assert policy == self.RANDOM
-                    clients.append(client)
-        if clients:
+                if excluded is None:
+                    excluded = client
+        # all connected boxes are tried
+        return excluded
+
+    def choose_client(self, clients, policy):
+        if not clients:
+            return None
+        if policy == self.RANDOM:
             return random.choice(clients)
+        elif policy == self.LEAST_OUTSTANDING:
+            return min(clients,
+                       key=lambda c: (c.inflight, c.load()))
+        else:
+            assert policy == self.P2C
+            if len(clients) == 1:
+                return clients[0]
+            a, b = random.sample(clients, 2)
+            return a if a.load() <= b.load() else b
+
+    def set_policy(self, name):
+        try:
+            self.policy = self.policy_names[name]
+        except KeyError:
+            raise ValueError('unknown dispatch policy {}'.format(name))
+
+    def set_codec(self, name):
+        # fail here rather than on the first connect
+        get_codec(name)
+        self.codec = name or None
 
     def __getattr__(self, name):
         return ServiceRef(name, self)
@@ -259,49 +752,232 @@ class FullConnectPool:
     def __getitem__(self, name):
         return ServiceRef(name, self)
 
-    async def request(self, srv, method, *params, boxid=None, retry=0, req_id=None, timeout=DEFAULT_TIMEOUT_SECS):
+    async def request(self, srv, method, *params, boxid=None, route_key=None, retry=0, req_id=None, timeout=DEFAULT_TIMEOUT_SECS, coalesce=False):
         if not req_id:
             req_id = uuid.uuid4().hex
         if has_service(srv):
             # if local has srv,
             # call it by default to avoid network failure
-            req = Request({
-                'id': req_id,
-                'params': params,
-                'method': '{}::{}'.format(srv, method)
-            })
+            req = local_request(srv, method, params, req_id)
             return await req.handle()
 
+        timeout = inherit_timeout(timeout)
+        pkey = None
+        cache_key = None
+        if coalesce or (srv, method) in self.cacheable:
+            pkey = params_key(params)
+        if (pkey is not None and self.result_cache is not None
+            and (srv, method) in self.cacheable):
+            cache_key = (srv, method, pkey)
+            hit, resp = self.result_cache.get(cache_key)
+            if hit:
+                # the cache hands out a copy
+                resp['id'] = req_id
+                return resp
+
+        if coalesce and pkey is not None:
+            # identical requests in flight share one round trip
+            key = (srv, method, pkey, boxid, route_key)
+            resp = await self.flights.do(
+                key,
+                lambda: self._request_retry(
+                    srv, method, *params, boxid=boxid,
+                    route_key=route_key, retry=retry,
+                    req_id=req_id, timeout=timeout))
+            # the response is shared by the coalesced callers,
+            # each gets a copy under its own id
+            resp = copy.deepcopy(resp)
+            resp['id'] = req_id
+        else:
+            resp = await self._request_retry(
+                srv, method, *params, boxid=boxid,
+                route_key=route_key, retry=retry,
+                req_id=req_id, timeout=timeout)
+
+        cache_ttl = resp.get('cache_ttl')
+        if (cache_ttl and 'result' in resp
+            and self.result_cache is not None):
+            self.cacheable.add((srv, method))
+            if cache_key is None:
+                pkey = params_key(params)
+                if pkey is not None:
+                    cache_key = (srv, method, pkey)
+            if cache_key is not None:
+                self.result_cache.put(cache_key, resp, ttl=cache_ttl)
+        return resp
+
+    async def stream(self, srv, method, *params, boxid=None, route_key=None, req_id=None, timeout=DEFAULT_TIMEOUT_SECS):
+        '''
+        async iterate the items of a streaming method
+        '''
+        if not req_id:
+            req_id = uuid.uuid4().hex
+        if has_service(srv):
+            # local calls get all items at once
+            req = local_request(srv, method, params, req_id)
+            resp = await req.handle()
+            raise_stream_error(resp)
+            for item in (resp.get('result') or ()):
+                yield item
+            return
+
+        timeout = inherit_timeout(timeout)
+        await self.ensure_clients(srv)
+        if route_key is not None and not boxid:
+            await self.ensure_key_client(srv, route_key)
+        client = self.get_client(srv, boxid=boxid,
+                                 route_key=route_key)
+        if not client:
+            raise ConnectionError(
+                'no available rpc server')
+        async for item in client.stream(srv, method, *params,
+                                        req_id=req_id,
+                                        timeout=timeout):
+            yield item
+
+    async def _request_retry(self, srv, method, *params, boxid=None, route_key=None, retry=0, req_id=None, timeout=DEFAULT_TIMEOUT_SECS):
+        tried = set()
+        busy_resp = None
         for rty in range(retry + 1):
             try:
                 return await self._request(
                     srv, method,
-                    *params, boxid=None,
+                    *params, boxid=boxid,
+                    route_key=route_key,
                     req_id=req_id,
-                    timeout=timeout
+                    timeout=timeout,
+                    tried=tried
                 )
-            except Retry:
+            except Retry as e:
+                if e.args:
+                    busy_resp = e.args[0]
                 continue
+        if busy_resp:
+            return busy_resp
         raise ConnectionError(
             'cannot retry connections')
 
-    async def _request(self, srv, method, *params, boxid=None, req_id=None, timeout=DEFAULT_TIMEOUT_SECS):
+    async def request_many(self, calls, retry=0, timeout=DEFAULT_TIMEOUT_SECS):
+        '''
+        request a list of (srv, method, params) calls, calls
+        dispatched to the same box are sent as one JSON-RPC batch.
+        The responses are returned in the order of calls, a call
+        failed by timeout or connection gets an error response
+        '''
+        results = [None] * len(calls)
+        req_ids = [uuid.uuid4().hex for _ in calls]
+        local_calls = []
+        pending = []
+        timeout = inherit_timeout(timeout)
+        for i, (srv, method, params) in enumerate(calls):
+            if has_service(srv):
+                req = local_request(srv, method, params, req_ids[i])
+                local_calls.append((i, req))
+            else:
+                pending.append(i)
+
+        if local_calls:
+            resps = await asyncio.gather(
+                *[req.handle() for _, req in local_calls])
+            for (i, _), resp in zip(local_calls, resps):
+                results[i] = resp
+
+        tried = defaultdict(set)
+        for rty in range(retry + 1):
+            if not pending:
+                return results
+            groups = defaultdict(list)
+            for i in pending:
+                srv = calls[i][0]
+                await self.ensure_clients(srv)
+                client = self.get_client(srv, exclude=tried[i])
+                if not client:
+                    if results[i] is None:
+                        results[i] = error_response(
+                            req_ids[i], 'ConnectionError',
+                            'no available rpc server')
+                    continue
+                tried[i].add(client.bind)
+                groups[client].append(i)
+
+            # a box takes a batch only within its inflight limit
+            fns = [self._request_chunks(client, idxs, calls,
+                                        req_ids, results,
+                                        timeout=timeout)
+                   for client, idxs in groups.items()]
+            failed = await asyncio.gather(*fns)
+            pending = [i for idxs in failed for i in idxs]
+
+        for i in pending:
+            if results[i] is None:
+                results[i] = error_response(
+                    req_ids[i], 'ConnectionError',
+                    'cannot retry connections')
+        # the rest are busy responses
+        return results
+
+    async def _request_chunks(self, client, idxs, calls, req_ids, results, timeout=DEFAULT_TIMEOUT_SECS):
+        size = min(self.max_batch, client.max_batch or self.max_batch)
+        size = max(1, size)
+        failed = await asyncio.gather(
+            *[self._request_group(client, idxs[k:k + size],
+                                  calls, req_ids, results,
+                                  timeout=timeout)
+              for k in range(0, len(idxs), size)])
+        return [i for idxs in failed for i in idxs]
+
+    async def _request_group(self, client, idxs, calls, req_ids, results, timeout=DEFAULT_TIMEOUT_SECS):
+        batch = [(calls[i][0], calls[i][1], calls[i][2], req_ids[i])
+                 for i in idxs]
+        try:
+            resps = await client.request_many(batch, timeout=timeout)
+        except ConnectionError:
+            # the calls are retried on other boxes
+            return idxs
+        except asyncio.TimeoutError:
+            for i in idxs:
+                results[i] = error_response(
+                    req_ids[i], 'TimeoutError', 'request timeout')
+            return []
+        if len(idxs) > 1 and is_batch_too_large(resps[0]):
+            # the box has a lower limit, resend in smaller batches
+            client.max_batch = len(idxs) // 2
+            return await self._request_chunks(client, idxs, calls,
+                                              req_ids, results,
+                                              timeout=timeout)
+        busy = []
+        for i, resp in zip(idxs, resps):
+            results[i] = resp
+            if is_busy(resp):
+                busy.append(i)
+        return busy
+
+    async def _request(self, srv, method, *params, boxid=None, route_key=None, req_id=None, timeout=DEFAULT_TIMEOUT_SECS, tried=None):
         await self.ensure_clients(srv)
-        client = self.get_client(srv, boxid=boxid)
+        if route_key is not None and not boxid:
+            await self.ensure_key_client(srv, route_key, exclude=tried)
+        client = self.get_client(srv, boxid=boxid,
+                                 route_key=route_key,
+                                 exclude=tried)
         if not client:
             raise ConnectionError(
                 'no available rpc server')
+        if tried is not None:
+            tried.add(client.bind)
 
         if not req_id:
             req_id = uuid.uuid4().hex
         try:
-            return await client.request(
+            resp = await client.request(
                 srv, method,
                 *params,
                 req_id=req_id,
                 timeout=timeout)
         except ConnectionError:
-            assert not client.connected
             raise Retry()
+        if is_busy(resp):
+            # rejected fast by a busy box, retry on another box
+            raise Retry(resp)
+        return resp
 
 pool = FullConnectPool()
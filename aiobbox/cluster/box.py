@@ -5,8 +5,9 @@ import json
 import time
 import asyncio
 import aio_etcd as etcd
-from aiobbox.utils import json_to_str
+from aiobbox.utils import json_to_fast_str
 from aiobbox.exceptions import RegisterFailed, ETCDError
+from aiobbox.admission import load_shedder
 from .etcd_client import EtcdClient
 from .ticket import get_ticket
 from .cfg import get_sharedconfig
@@ -20,6 +21,8 @@ class BoxAgent(EtcdClient):
         super(BoxAgent, self).__init__()
         self.ssl_prefix = None
         self.started = False
+        # the overloaded state last written to etcd
+        self.reported_overload = False
 
     async def start(self, boxid, srv_names):
         assert not self.started
@@ -33,14 +36,30 @@ class BoxAgent(EtcdClient):
         await self.register()
         self.started = True
 
+    def attach(self, boxid, srv_names, bind):
+        '''
+        run as a worker of a box registered by the supervisor,
+        the worker neither registers nor refreshes the etcd entry
+        '''
+        assert not self.started
+        assert boxid
+
+        self.boxid = boxid
+        self.srv_names = srv_names
+        self.bind = bind
+        self.extbind = bind
+        self.client = None
+        self.cont = False
+        self.started = True
 
     def box_info(self, extbind=None):
         extbind = extbind or self.extbind
-        return json_to_str({
+        return json_to_fast_str({
             'bind': extbind,
             'ssl': self.ssl_prefix,
             'boxid': self.boxid,
-            'services': self.srv_names})
+            'services': self.srv_names,
+            'load': load_shedder.load_info()})
 
     def get_box_config(self, key, default=None):
         config = get_sharedconfig()
@@ -107,7 +126,14 @@ class BoxAgent(EtcdClient):
             else:
                 key = self.path('boxes/{}'.format(self.bind))
                 try:
-                    await self.refresh(key, ttl=BOX_TTL)
+                    overloaded = load_shedder.overloaded
+                    if overloaded != self.reported_overload:
+                        # rewrite the value only when the state flips
+                        await self.write(key, self.box_info(),
+                                         ttl=BOX_TTL)
+                        self.reported_overload = overloaded
+                    else:
+                        await self.refresh(key, ttl=BOX_TTL)
                 except etcd.EtcdKeyNotFound:
                     logger.warn('etcd key not found %s', key)
                     value = self.box_info()
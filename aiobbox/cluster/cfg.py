@@ -3,7 +3,7 @@ import re
 import time
 import json
 import sys
-from aiobbox.utils import json_pp, json_to_str
+from aiobbox.utils import json_pp, json_to_fast_str
 
 class SharedConfig:
     def __init__(self):
@@ -73,12 +73,12 @@ class SharedConfig:
         vset = set()
         for sec, section in sorted(new_sections.items()):
             for key, value in sorted(section.items()):
-                value = json_to_str(value)
+                value = json_to_fast_str(value)
                 new_vset.add((sec, key, value))
 
         for sec, section in sorted(self.sections.items()):
             for key, value in sorted(section.items()):
-                value = json_to_str(value)
+                value = json_to_fast_str(value)
                 vset.add((sec, key, value))
 
         will_delete = vset - new_vset
@@ -8,68 +8,226 @@ import aio_etcd as etcd
 import aiohttp
 from collections import defaultdict
 from aiobbox.utils import json_to_str, localbox_ip
+from aiobbox.codec import json_loads
 from aiobbox.exceptions import RegisterFailed, ETCDError
 from .etcd_client import EtcdClient
 from .cfg import SharedConfig, get_sharedconfig
+from .hashring import HashRing
+from .snapshot import load_snapshot, save_snapshot
 
 logger = logging.getLogger('bbox')
 
+BOX_KEY_REG = r'/[^/]+/boxes/(?P<box>[^/]+)$'
+CONFIG_KEY_REG = r'/(?P<prefix>[^/]+)/configs(/(?P<sec>[^/]+))?(/(?P<key>[^/]+))?$'
+
+DELETE_ACTIONS = ('delete', 'expire', 'compareAndDelete')
+
+# seconds between checks to save a changed view to the snapshot
+SNAPSHOT_INTERVAL = 10
+
 class ClientAgent(EtcdClient):
     def __init__(self):
         super(ClientAgent, self).__init__()
         self.state = 'INIT'
+        # bumped on every change of route and boxes
+        self.route_version = 0
+        # bumped on every change of shared config
+        self.config_version = 0
 
-    async def start(self):
+    async def start(self, use_snapshot=True):
+        '''
+        with a snapshot of the last known view the client starts
+        at once and reconciles with etcd in background
+        '''
         self.route = defaultdict(list)
         self.boxes = {}
+        self.box_keys = {}
+        self.rings = {}
 
         self.connect()
 
-        await self.get_boxes()
-        await self.get_configs()
-
-        asyncio.ensure_future(self._watch_boxes())
-        asyncio.ensure_future(self._watch_configs())
+        snapshot = None
+        if use_snapshot:
+            snapshot = load_snapshot(self.prefix)
+        if snapshot:
+            self.load_view(snapshot)
+            asyncio.ensure_future(self.reconcile())
+        else:
+            boxes_index = await self.get_boxes()
+            configs_index = await self.get_configs()
+            self.start_watches(boxes_index, configs_index)
+            if use_snapshot:
+                self.save_snapshot()
+        asyncio.ensure_future(self.keep_snapshot())
         self.state = 'STARTED'
 
+    def start_watches(self, boxes_index, configs_index):
+        asyncio.ensure_future(self._watch_boxes(boxes_index))
+        asyncio.ensure_future(self._watch_configs(configs_index))
+
+    def load_view(self, snapshot):
+        boxes = snapshot['boxes']
+        route = defaultdict(list)
+        for bind, box_info in boxes.items():
+            for srv in box_info['services']:
+                route[srv].append(bind)
+        self.route = route
+        self.boxes = boxes
+        self.box_keys = {bind: bind for bind in boxes}
+        self.route_version += 1
+        self.update_rings()
+
+        new_conf = SharedConfig()
+        new_conf.sections = snapshot['configs']
+        get_sharedconfig().replace_with(new_conf)
+        self.config_version += 1
+
+    async def reconcile(self):
+        '''
+        replace the snapshot view with the etcd view, the snapshot
+        keeps serving while etcd is unavailable
+        '''
+        while self.cont:
+            try:
+                boxes_index = await self.get_boxes()
+                break
+            except ETCDError:
+                logger.warn('etcd unavailable, route on the snapshot')
+                await asyncio.sleep(1)
+        else:
+            return
+        configs_index = await self.get_configs()
+        self.start_watches(boxes_index, configs_index)
+
+        # saved even if unchanged, saved_at is the time
+        # the view was last confirmed by etcd
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        save_snapshot(self.prefix, self.boxes,
+                      get_sharedconfig().sections)
+
+    async def keep_snapshot(self):
+        saved = (self.route_version, self.config_version)
+        while self.cont:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            version = (self.route_version, self.config_version)
+            if version != saved and self.cont:
+                self.save_snapshot()
+                saved = version
+
     def get_local_boxes(self):
         for bind in self.boxes.keys():
             if localbox_ip(bind.split(':')[0]):
                 yield bind
 
-    async def get_boxes(self, chg=None):
-        if chg:
-            logger.debug('get boxes on change %s', chg)
+    async def get_boxes(self):
+        '''
+        read the whole boxes tree, return the etcd index
+        to watch from
+        '''
         new_route = defaultdict(list)
         boxes = {}
+        box_keys = {}
+        next_index = None
         try:
             r = await self.read(self.path('boxes'),
                                 recursive=True)
+            next_index = r.etcd_index + 1
             for v in self.walk(r):
-                m = re.match(r'/[^/]+/boxes/(?P<box>[^/]+)$', v.key)
+                m = re.match(BOX_KEY_REG, v.key)
                 if not m:
                     continue
                 if not v.value:
                     #logger.warn('v has no value %s', v)
                     continue
-                box_info = json.loads(v.value)
+                box_info = json_loads(v.value)
                 bind = box_info['bind']
                 boxes[bind] = box_info
+                box_keys[m.group('box')] = bind
                 for srv in box_info['services']:
                     new_route[srv].append(bind)
         except etcd.EtcdKeyNotFound:
             pass
         self.route = new_route
         self.boxes = boxes
+        self.box_keys = box_keys
+        self.route_version += 1
+        self.update_rings()
+        return next_index
+
+    async def apply_box_change(self, chg):
+        m = re.match(BOX_KEY_REG, chg.key)
+        if not m:
+            if chg.action in DELETE_ACTIONS:
+                # the whole boxes dir is removed
+                self.route = defaultdict(list)
+                self.boxes = {}
+                self.box_keys = {}
+                self.route_version += 1
+                self.update_rings()
+            return
+
+        key = m.group('box')
+        self.remove_box(key)
+        if chg.action not in DELETE_ACTIONS and chg.value:
+            self.add_box(key, json_loads(chg.value))
+
+    def add_box(self, key, box_info):
+        bind = box_info['bind']
+        self.box_keys[key] = bind
+        self.boxes[bind] = box_info
+        self.route_version += 1
+        for srv in box_info['services']:
+            binds = self.route[srv]
+            if bind not in binds:
+                binds.append(bind)
+            ring = self.rings.get(srv)
+            if ring is not None:
+                ring.add_node(bind)
+
+    def remove_box(self, key):
+        bind = self.box_keys.pop(key, None)
+        if bind is None:
+            return
+        box_info = self.boxes.pop(bind, None)
+        if not box_info:
+            return
+        self.route_version += 1
+        for srv in box_info['services']:
+            binds = self.route.get(srv)
+            if binds and bind in binds:
+                binds.remove(bind)
+                if not binds:
+                    del self.route[srv]
+            ring = self.rings.get(srv)
+            if ring is not None:
+                ring.remove_node(bind)
+
+    def update_rings(self):
+        for srv, ring in self.rings.items():
+            ring.update_nodes(self.route.get(srv, ()))
+
+    def get_ring(self, srv):
+        '''
+        the consistent hash ring of boxes providing srv
+        '''
+        ring = self.rings.get(srv)
+        if ring is None:
+            ring = HashRing(self.route.get(srv, ()))
+            self.rings[srv] = ring
+        return ring
 
     def get_box(self, srv):
         boxes = self.route[srv]
         return random.choice(boxes)
 
-    async def _watch_boxes(self):
-        return await self.watch_changes(
+    async def _watch_boxes(self, next_index=None):
+        return await self.watch_events(
             'boxes',
-            self.get_boxes)
+            self.apply_box_change,
+            self.get_boxes,
+            next_index=next_index)
 
     # config related
     async def set_config(self, sec, key, value):
@@ -116,11 +274,17 @@ class ClientAgent(EtcdClient):
             logger.debug(
                 'key %s not found on delete', etcd_key)
 
-    async def get_configs(self, chg=None):
+    async def get_configs(self):
+        '''
+        read the whole configs tree, return the etcd index
+        to watch from
+        '''
         reg = r'/(?P<prefix>[^/]+)/configs/(?P<sec>[^/]+)/(?P<key>[^/]+)'
+        next_index = None
         try:
             r = await self.read(self.path('configs'),
                                 recursive=True)
+            next_index = r.etcd_index + 1
             new_conf = SharedConfig()
             for v in self.walk(r):
                 m = re.match(reg, v.key)
@@ -128,21 +292,45 @@ class ClientAgent(EtcdClient):
                     assert m.group('prefix') == self.prefix
                     sec = m.group('sec')
                     key = m.group('key')
-                    new_conf.set(sec, key, json.loads(v.value))
+                    new_conf.set(sec, key, json_loads(v.value))
 
             curr_conf = get_sharedconfig()
             delete_set, add_set = curr_conf.compare_sections(
                 new_conf.sections)
             if delete_set or add_set:
                 curr_conf.replace_with(new_conf)
+                self.config_version += 1
 
         except etcd.EtcdKeyNotFound:
             pass
         except ETCDError:
             pass
+        return next_index
+
+    async def apply_config_change(self, chg):
+        m = re.match(CONFIG_KEY_REG, chg.key)
+        if not m:
+            return
+        sec = m.group('sec')
+        key = m.group('key')
+        shared_cfg = get_sharedconfig()
+        self.config_version += 1
+        if chg.action in DELETE_ACTIONS:
+            if key:
+                shared_cfg.delete(sec, key)
+            elif sec:
+                shared_cfg.delete_section(sec)
+            else:
+                shared_cfg.clear()
+        elif key and chg.value is not None:
+            shared_cfg.set(sec, key, json_loads(chg.value))
 
-    async def _watch_configs(self):
-        return await self.watch_changes('configs', self.get_configs)
+    async def _watch_configs(self, next_index=None):
+        return await self.watch_events(
+            'configs',
+            self.apply_config_change,
+            self.get_configs,
+            next_index=next_index)
 
 _agent = ClientAgent()
 def get_cluster():
@@ -95,29 +95,49 @@ class EtcdClient:
             for cc in self.walk(c):
                 yield cc
 
-    async def watch_changes(self, component, changed):
-        last_index = None
+    async def watch_events(self, component, apply_change, resync,
+                           next_index=None):
+        '''
+        watch the component tree and apply each change event,
+        resync() re-reads the whole tree and returns the index to
+        watch from, it is called only when events are lost
+        '''
+        resync_needed = False
         while self.cont:
-            logger.debug('watching %s', component)
+            if resync_needed:
+                try:
+                    next_index = await resync()
+                    resync_needed = False
+                except ETCDError:
+                    logger.warn('etcd error, sleep for a while')
+                    await asyncio.sleep(1)
+                    continue
+
+            logger.debug('watching %s from %s', component, next_index)
             try:
                 # watch every 1 min to
                 # avoid timeout exception
                 chg = await asyncio.wait_for(
                     self.read(self.path(component),
                               recursive=True,
-                              waitIndex=last_index,
+                              waitIndex=next_index,
                               wait=True),
                     timeout=60)
-                last_index = chg.modifiedIndex
-                await changed(chg)
             except asyncio.TimeoutError:
                 logger.debug(
                     'timeout error during watching %s',
                     component)
+                continue
+            except etcd.EtcdEventIndexCleared:
+                logger.info('events of %s lost, resync', component)
+                resync_needed = True
+                continue
             except ETCDError:
                 logger.warn('etcd error, sleep for a while')
                 await asyncio.sleep(1)
-            await changed(None)
+                continue
+            next_index = chg.modifiedIndex + 1
+            await apply_change(chg)
 
     def acquire_lock(self, name):
         #cfg = get_ticket()
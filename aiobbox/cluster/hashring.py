@@ -0,0 +1,65 @@
+import bisect
+from hashlib import md5
+
+DEFAULT_VNODES = 64
+
+def hash_key(key):
+    digest = md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+class HashRing:
+    '''
+    consistent hash ring of box binds, each bind is placed
+    on the ring as vnodes points
+    '''
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self.nodes = set()
+        self.points = []   # sorted (hash, node) tuples
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            h = hash_key('{}#{}'.format(node, i))
+            bisect.insort(self.points, (h, node))
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self.points = [p for p in self.points if p[1] != node]
+
+    def update_nodes(self, nodes):
+        '''
+        apply the membership change only
+        '''
+        nodes = set(nodes)
+        for node in self.nodes - nodes:
+            self.remove_node(node)
+        for node in nodes - self.nodes:
+            self.add_node(node)
+
+    def iter_nodes(self, key):
+        '''
+        yield distinct nodes clockwise from the position of key
+        '''
+        if not self.points:
+            return
+        start = bisect.bisect(self.points, (hash_key(key),))
+        seen = set()
+        npoints = len(self.points)
+        for i in range(npoints):
+            node = self.points[(start + i) % npoints][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+    def get_node(self, key):
+        for node in self.iter_nodes(key):
+            return node
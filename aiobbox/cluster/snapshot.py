@@ -0,0 +1,72 @@
+import os
+import time
+import logging
+from aiobbox.utils import get_bbox_path
+from aiobbox.codec import json_dumps, json_loads
+
+'''
+the last known boxes and shared config saved under .bbox/, so that
+a client can start without waiting for etcd and keeps routing on
+the last good view during etcd outages
+'''
+
+logger = logging.getLogger('bbox')
+
+SNAPSHOT_VERSION = 1
+
+# snapshots older than that are not used, the client
+# starts from etcd as if there were no snapshot
+SNAPSHOT_MAX_AGE = 24 * 3600
+
+def snapshot_path(prefix):
+    ticket_path = get_bbox_path('ticket.json')
+    if not ticket_path:
+        return None
+    return os.path.join(os.path.dirname(ticket_path),
+                        'snapshot.{}.json'.format(prefix))
+
+def save_snapshot(prefix, boxes, sections):
+    path = snapshot_path(prefix)
+    if not path:
+        return
+    data = {
+        'version': SNAPSHOT_VERSION,
+        'prefix': prefix,
+        'saved_at': time.time(),
+        'boxes': boxes,
+        'configs': sections
+    }
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        # the shared config may contain secrets
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(json_dumps(data))
+        os.replace(tmp_path, path)
+    except OSError:
+        logger.warn('fail to save snapshot %s', path, exc_info=True)
+
+def load_snapshot(prefix, max_age=SNAPSHOT_MAX_AGE):
+    path = snapshot_path(prefix)
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json_loads(f.read())
+    except (OSError, ValueError):
+        logger.warn('fail to load snapshot %s', path, exc_info=True)
+        return None
+    if (not isinstance(data, dict)
+        or data.get('version') != SNAPSHOT_VERSION
+        or data.get('prefix') != prefix):
+        return None
+    saved_at = data.get('saved_at')
+    if not isinstance(saved_at, (int, float)):
+        return None
+    age = time.time() - saved_at
+    if max_age is not None and age > max_age:
+        logger.warn('snapshot %s too old, saved %.0fs ago', path, age)
+        return None
+    logger.info('start from snapshot %s saved %.0fs ago', path, age)
+    return data
@@ -0,0 +1,170 @@
+import os
+import json
+
+'''
+wire codecs of JSON-RPC messages, JSON is the default codec,
+the binary codecs are available once their packages are installed.
+A websocket client and a box negotiate the codec by websocket
+subprotocols, HTTP requests select the codec by Content-Type.
+
+JSON goes through an accelerated library (orjson or ujson) when
+one is installed, the env BBOX_JSON_BACKEND=json forces stdlib json
+'''
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+json_backend = os.getenv('BBOX_JSON_BACKEND', '').lower()
+if not json_backend:
+    if orjson is not None:
+        json_backend = 'orjson'
+    elif ujson is not None:
+        json_backend = 'ujson'
+    else:
+        json_backend = 'json'
+
+if json_backend == 'orjson':
+    def json_dumps(v, sort_keys=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(v, option=option).decode('utf-8')
+        except TypeError:
+            # orjson rejects some values stdlib accepts,
+            # such as integers beyond 64 bits
+            return json.dumps(v, sort_keys=sort_keys)
+
+    def json_loads(data):
+        return orjson.loads(data)
+elif json_backend == 'ujson':
+    def json_dumps(v, sort_keys=False):
+        return ujson.dumps(v, sort_keys=sort_keys,
+                           escape_forward_slashes=False)
+
+    def json_loads(data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return ujson.loads(data)
+else:
+    json_backend = 'json'
+    def json_dumps(v, sort_keys=False):
+        return json.dumps(v, sort_keys=sort_keys)
+
+    def json_loads(data):
+        return json.loads(data)
+
+class JSONCodec:
+    name = 'json'
+    content_type = 'application/json'
+    binary = False
+
+    def dumps(self, v):
+        return json_dumps(v)
+
+    def loads(self, data):
+        return json_loads(data)
+
+class MsgpackCodec:
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+    binary = True
+
+    def dumps(self, v):
+        return msgpack.packb(v, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+class CBORCodec:
+    name = 'cbor'
+    content_type = 'application/cbor'
+    binary = True
+
+    def dumps(self, v):
+        return cbor2.dumps(v)
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+json_codec = JSONCodec()
+
+_codecs = {json_codec.name: json_codec}
+if msgpack is not None:
+    _codecs[MsgpackCodec.name] = MsgpackCodec()
+if cbor2 is not None:
+    _codecs[CBORCodec.name] = CBORCodec()
+
+WS_PROTOCOL_PREFIX = 'bbox.'
+
+def codec_names():
+    '''
+    names of the codecs installed
+    '''
+    return sorted(_codecs)
+
+def get_codec(name):
+    if not name:
+        return json_codec
+    codec = _codecs.get(name)
+    if codec is None:
+        raise ValueError('codec {} not available'.format(name))
+    return codec
+
+def get_codec_by_protocol(protocol):
+    if protocol and protocol.startswith(WS_PROTOCOL_PREFIX):
+        name = protocol[len(WS_PROTOCOL_PREFIX):]
+        return _codecs.get(name, json_codec)
+    return json_codec
+
+def get_codec_by_content_type(content_type):
+    for codec in _codecs.values():
+        if codec.content_type == content_type:
+            return codec
+    return json_codec
+
+def box_ws_protocols():
+    '''
+    all websocket subprotocols the box accepts
+    '''
+    return tuple(WS_PROTOCOL_PREFIX + name for name in _codecs)
+
+def client_ws_protocols(prefer=None):
+    '''
+    websocket subprotocols offered by a client, the preferred
+    codec first and JSON as the fallback
+    '''
+    names = [get_codec(prefer).name, json_codec.name]
+    if names[0] == names[1]:
+        names.pop()
+    return tuple(WS_PROTOCOL_PREFIX + name for name in names)
+
+def encode_body(codec, v):
+    data = codec.dumps(v)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return data
+
+async def send_ws(ws, codec, v):
+    data = codec.dumps(v)
+    if codec.binary:
+        await ws.send_bytes(data)
+    else:
+        await ws.send_str(data)
@@ -52,8 +52,8 @@ async def create_consumer(request, consumer, reuse):
         'secret': coptions['secret']
     }
 
-@srv.method('createToken')
-async def create_consumer_token(request, consumer, secret, options=None):
+@srv.method('createToken', executor='thread')
+def create_consumer_token(request, consumer, secret, options=None):
     '''
     createToken(consumer, secret, options=None)
     Create a consume token by preallocated consumer and secret
@@ -94,8 +94,8 @@ async def create_consumer_token(request, consumer, secret, options=None):
         'expire_at': expire_at
     }
 
-@srv.method('verifyToken')
-async def verify_consumer_token(request, token):
+@srv.method('verifyToken', executor='thread')
+def verify_consumer_token(request, token):
     '''
     verifyToken(token)
     verify a token, it may be invalid or expired
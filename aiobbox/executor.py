@@ -0,0 +1,64 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from aiobbox.cluster import get_box
+from aiobbox.metrics import add_metrics
+
+'''
+managed executors to run blocking service methods off the event loop,
+pool sizes are read from the box config thread_pool_size and
+process_pool_size, the default size is decided by concurrent.futures
+'''
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+_executor_classes = {
+    THREAD: ThreadPoolExecutor,
+    PROCESS: ProcessPoolExecutor
+}
+
+_executors = {}
+
+def get_pool_size(kind):
+    box = get_box()
+    if not box.started:
+        return None
+    return box.get_box_config('{}_pool_size'.format(kind))
+
+def get_executor(kind):
+    executor = _executors.get(kind)
+    if executor is None:
+        cls = _executor_classes[kind]
+        executor = cls(max_workers=get_pool_size(kind))
+        _executors[kind] = executor
+    return executor
+
+class ExecutorQueueDepth:
+    name = 'executor_queue_depth'
+    help = 'calls submitted to the executor and not finished yet'
+    type = 'gauge'
+
+    def __init__(self):
+        self.values = defaultdict(int)
+
+    async def collect(self):
+        return [({'executor': kind}, v)
+                for kind, v in self.values.items()]
+
+queue_depth = ExecutorQueueDepth()
+add_metrics(queue_depth)
+
+async def run_in_executor(kind, fn, *args):
+    executor = get_executor(kind)
+    loop = asyncio.get_event_loop()
+    queue_depth.values[kind] += 1
+    try:
+        return await loop.run_in_executor(executor, fn, *args)
+    finally:
+        queue_depth.values[kind] -= 1
+
+def shutdown_executors(wait=True):
+    for executor in _executors.values():
+        executor.shutdown(wait=wait)
+    _executors.clear()
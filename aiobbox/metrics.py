@@ -1,9 +1,22 @@
+import uuid
 import asyncio
-from collections import defaultdict
-from aiobbox.cluster import get_cluster
+import logging
+from aiobbox.cluster import get_cluster, get_box
+
+logger = logging.getLogger('bbox')
 
 _metrics = []
 
+# default cap of label sets per metric, label sets beyond
+# the cap are counted into one overflow series
+MAX_SERIES = 1000
+OVERFLOW_LABEL = '__overflow__'
+
+# the service of the metrics daemon accepting pushed metrics
+PUSH_SRV = 'bbox.metrics'
+# name suffixes of the samples of a histogram
+HISTOGRAM_SUFFIXES = ('_bucket', '_sum', '_count')
+
 def add_metrics(obj):
     assert getattr(obj, 'name', None)
     assert getattr(obj, 'help', None)
@@ -22,8 +35,15 @@ async def collect_metrics():
             'help': obj.help,
             'type': obj.type
         }
-        for labels, v in res:
-            lines.append((obj.name, labels, v))
+        for item in res:
+            if len(item) == 3:
+                # a sample of a multi line metric such as
+                # histogram, the name is suffixed
+                suffix, labels, v = item
+                lines.append((obj.name + suffix, labels, v))
+            else:
+                labels, v = item
+                lines.append((obj.name, labels, v))
     return {
         'meta': meta,
         'lines': lines
@@ -67,36 +87,164 @@ def report_box_failure(bind):
         'lines': lines
         }
 
-class MetricsCount:
+class MetricChild:
+    '''
+    the value of one label set, bind it once by
+    metric.labels(...) and update it on the hot path
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, v=1):
+        self.value += v
+
+    def dec(self, v=1):
+        self.value -= v
+
+    def set(self, v):
+        self.value = v
+
+class Counter:
+    '''
+    a metric of children interned by label values, values
+    are kept across scrapes
+    '''
     name = None
     help = None
-    field_name = None
-    type = 'gauge'
+    type = 'counter'
+    labelnames = ()
 
-    values = defaultdict(int)
-    def incr(self, coin):
-        self.values[coin] += 1
+    def __init__(self, name=None, help=None, labelnames=None,
+                 max_series=MAX_SERIES):
+        if name:
+            self.name = name
+        if help:
+            self.help = help
+        elif not self.help and self.name:
+            self.help = self.name.replace('_', ' ')
+        if labelnames is not None:
+            self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.new_child(values)
+        return child
+
+    def new_child(self, values):
+        assert len(values) == len(self.labelnames)
+        if len(self.children) >= self.max_series:
+            values = (OVERFLOW_LABEL,) * len(self.labelnames)
+            child = self.children.get(values)
+            if child is not None:
+                return child
+            logger.warn('metric %s exceeds %s label sets',
+                        self.name, self.max_series)
+        child = MetricChild()
+        self.children[values] = child
+        return child
 
     async def collect(self):
-        metr = []
-        for coin, cnt in self.values.items():
-            metr.append(({self.field_name: coin}, cnt))
-        self.values.clear()
-        return metr
+        return [(dict(zip(self.labelnames, values)), child.value)
+                for values, child in self.children.items()]
 
-class MetricsAmount:
-    name = None
-    help = None
-    field_name = None
+class Gauge(Counter):
     type = 'gauge'
 
-    values = defaultdict(float)
+class MetricsCount(Counter):
+    field_name = None
+
+    def __init__(self, **kw):
+        kw.setdefault('labelnames', (self.field_name,))
+        super(MetricsCount, self).__init__(**kw)
+
+    def incr(self, coin):
+        self.labels(coin).inc()
+
+class MetricsAmount(Counter):
+    field_name = None
+
+    def __init__(self, **kw):
+        kw.setdefault('labelnames', (self.field_name,))
+        super(MetricsAmount, self).__init__(**kw)
+
     def add(self, key, amount):
-        self.values[key] += amount
+        self.labels(key).inc(amount)
 
-    async def collect(self):
-        metr = []
-        for key, cnt in self.values.items():
-            metr.append(({self.field_name: key}, cnt))
-        self.values.clear()
-        return metr
+def metric_type(meta, name):
+    define = meta.get(name)
+    if define is None:
+        for suffix in HISTOGRAM_SUFFIXES:
+            if name.endswith(suffix):
+                define = meta.get(name[:-len(suffix)])
+                break
+    if define is None:
+        return 'gauge'
+    return define['type']
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+class MetricsPusher:
+    '''
+    push metrics of the box to the metrics daemon, counters and
+    histograms are sent as cumulative values and the daemon takes
+    the deltas, so a push applied twice is not counted twice
+    '''
+    def __init__(self):
+        self.cont = False
+        self.interval = 0
+        # the pushing process, a new instance restarts the series
+        self.instance = uuid.uuid4().hex
+        self.seq = 0
+
+    def configure(self, box):
+        self.interval = box.get_box_config(
+            'metrics_push_interval', 0)
+
+    def start(self):
+        if self.interval and not self.cont:
+            self.cont = True
+            asyncio.ensure_future(self.push_loop())
+
+    def stop(self):
+        self.cont = False
+
+    async def make_push(self):
+        resp = await collect_metrics()
+        meta = resp['meta']
+        counters = []
+        gauges = []
+        for name, labels, v in resp['lines']:
+            if metric_type(meta, name) in ('counter', 'histogram'):
+                counters.append((name, labels, v))
+            else:
+                gauges.append((name, labels, v))
+        self.seq += 1
+        return {
+            'instance': self.instance,
+            'seq': self.seq,
+            'meta': meta,
+            'counters': counters,
+            'gauges': gauges
+            }
+
+    async def push_loop(self):
+        from aiobbox.client import pool
+        while self.cont:
+            await asyncio.sleep(self.interval)
+            try:
+                data = await self.make_push()
+                r = await pool.request(PUSH_SRV, 'push',
+                                       get_box().boxid, data)
+            except Exception:
+                logger.warn('fail to push metrics', exc_info=True)
+                continue
+            if r.get('error'):
+                logger.warn('fail to push metrics %s', r['error'])
+
+metrics_pusher = MetricsPusher()
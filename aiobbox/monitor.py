@@ -0,0 +1,82 @@
+import gc
+import time
+import asyncio
+from aiobbox.metrics import add_metrics, Gauge
+from aiobbox.stats import HistogramMetric
+from aiobbox.admission import load_shedder
+
+'''
+runtime state of the box exported as metrics, most slow calls
+come from a blocked event loop that these metrics reveal
+'''
+
+# upper bounds in seconds of loop lag and gc pause buckets
+PAUSE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class LoopLag:
+    name = 'event_loop_lag_ewma_seconds'
+    help = 'moving average of the event loop scheduling lag'
+    type = 'gauge'
+
+    async def collect(self):
+        return [({}, load_shedder.loop_lag)]
+
+class TaskCount:
+    name = 'asyncio_tasks'
+    help = 'live asyncio tasks'
+    type = 'gauge'
+
+    async def collect(self):
+        return [({}, len(asyncio.all_tasks()))]
+
+class PoolWaiters:
+    name = 'pool_waiters'
+    help = 'requests waiting for responses of a box'
+    type = 'gauge'
+
+    async def collect(self):
+        from aiobbox.client import pool
+        return [({'bind': bind}, client.waiters)
+                for bind, client in pool.pool.items()]
+
+ws_connections = Gauge(
+    'ws_connections',
+    help='open websocket connections')
+open_ws = ws_connections.labels()
+
+loop_lag_samples = HistogramMetric(
+    'event_loop_lag_seconds',
+    help='event loop scheduling lag',
+    buckets=PAUSE_BUCKETS)
+
+gc_pause = HistogramMetric(
+    'gc_pause_seconds',
+    help='garbage collection pause',
+    labelname='generation',
+    buckets=PAUSE_BUCKETS)
+
+class BoxMonitor:
+    def __init__(self):
+        self.started = False
+        self.gc_start = None
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        for obj in (LoopLag(), loop_lag_samples, TaskCount(),
+                    ws_connections, PoolWaiters(), gc_pause):
+            add_metrics(obj)
+        load_shedder.on_lag = loop_lag_samples.labels().observe
+        gc.callbacks.append(self.on_gc)
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            gc_pause.observe(str(info['generation']),
+                             time.perf_counter() - self.gc_start)
+            self.gc_start = None
+
+box_monitor = BoxMonitor()
@@ -2,12 +2,11 @@ import logging
 import asyncio
 import random
 import aiohttp
-from aiochannel import Channel
-from aiochannel.errors import ChannelClosed
 from urllib.parse import urljoin
 import json
 import uuid
 from aiobbox.exceptions import ConnectionError, Retry
+from aiobbox.codec import json_dumps, json_loads
 
 logger = logging.getLogger('bboxremote')
 
@@ -34,7 +33,7 @@ class HttpClient:
             }
         async with self.session.post(
                 url, json=payload, timeout=10) as resp:
-            ret = await resp.json()
+            ret = await resp.json(loads=json_loads)
             return ret
 
     def __del__(self):
@@ -91,25 +90,25 @@ class WebSocketClient:
             'params': params
             }
 
-        channel = Channel(1)
-        self.waiters[req_id] = channel
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters[req_id] = fut
         try:
-            await self.ws.send_json(payload)
-            r = await channel.get()
-            #del self.waiters[req_id]
+            await self.ws.send_json(payload, dumps=json_dumps)
+            r = await fut
             return r
-        except ChannelClosed:
-            raise ConnectionError(
-                'websocket closed on sending req')
         finally:
-            channel.close()
+            # remove the waiter on cancel
+            self.waiters.pop(req_id, None)
 
     async def onclosed(self):
         self.ws = None
-        for req_id, channel in self.waiters.items():
-            channel.close()
-        self.session.close()
+        waiters = self.waiters
         self.waiters = {}
+        for fut in waiters.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError(
+                    'websocket closed on sending req'))
+        self.session.close()
 
     async def connect_wait(self):
         while self.cont:
@@ -120,7 +119,7 @@ class WebSocketClient:
                 continue
             msg = await self.ws.receive()
             if msg.type == aiohttp.WSMsgType.TEXT:
-                data = json.loads(msg.data)
+                data = json_loads(msg.data)
             elif msg.type == aiohttp.WSMsgType.BINARY:
                 continue
             elif msg.type == aiohttp.WSMsgType.PING:
@@ -140,14 +139,13 @@ class WebSocketClient:
 
             req_id = data.get('id')
             if req_id:
-                channel = self.waiters.get(req_id)
-                if channel:
-                    del self.waiters[req_id]
-                    await channel.put(data)
-                else:
-                    logger.warn('Cannot find channel by id ', req_id)
+                fut = self.waiters.pop(req_id, None)
+                if fut is None:
+                    logger.warn('Cannot find waiter by id %s', req_id)
+                elif not fut.done():
+                    fut.set_result(data)
             else:
-                logger.debug('no reqid seems a notify', data)
+                logger.debug('no reqid seems a notify %s', data)
 
 class MethodRef:
     def __init__(self, name, srv_ref):
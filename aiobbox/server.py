@@ -4,26 +4,142 @@ import logging
 import os, json
 import asyncio
 import json
+import contextvars
+import inspect
 from aiohttp import web
 from functools import wraps
 from aiobbox import testing
 from aiobbox.cluster import get_box, get_cluster
 from aiobbox.exceptions import ServiceError
 from aiobbox.utils import parse_method, get_ssl_context, localbox_ip
-from aiobbox.metrics import collect_metrics
+from aiobbox.metrics import collect_metrics, metrics_pusher
+from aiobbox.monitor import box_monitor, open_ws
 from aiobbox import stats
+from aiobbox import executor as bbox_executor
+from aiobbox.admission import Gate, BUSY_ERROR
+from aiobbox.admission import get_box_gate, parse_priority
+from aiobbox.admission import load_shedder, OVERLOAD_ERROR
+from aiobbox.singleflight import SingleFlight, params_key
+from aiobbox.cache import ResultCache
+from aiobbox.codec import json_codec, send_ws, encode_body
+from aiobbox.codec import box_ws_protocols, get_codec_by_protocol
+from aiobbox.codec import get_codec_by_content_type, json_dumps
 
 DEBUG = True
 srv_dict = {}
 
+# in-flight websocket messages per connection and per box,
+# overridden by box config ws_max_inflight and box_max_inflight
+WS_MAX_INFLIGHT = 100
+BOX_MAX_INFLIGHT = 1000
+
+_box_semaphore = None
+_box_limit = BOX_MAX_INFLIGHT
+# held by a batch while it takes its box slots
+_box_batch_lock = None
+
+# the error code of websocket batches over the inflight limits
+BATCH_TOO_LARGE = 'batch too large'
+
+DEADLINE_ERROR = 'deadline exceeded'
+
+# the keys of the cache option of Service.method
+CACHE_OPTIONS = ('ttl', 'max_entries', 'max_bytes', 'client_ttl')
+
+class MethodTimeout(Exception):
+    '''
+    wraps a timeout raised inside a method
+    '''
+
+class StreamCredit:
+    '''
+    the count of chunks the client is ready to receive,
+    a stream waits for credit before sending each chunk
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.event = asyncio.Event()
+
+    def grant(self, n):
+        self.n += n
+        self.event.set()
+
+    async def acquire(self):
+        while self.n <= 0:
+            self.event.clear()
+            await self.event.wait()
+        self.n -= 1
+
+# the absolute deadline of the request being served, pool
+# requests made by a service method inherit the rest of it
+_deadline = contextvars.ContextVar('bbox_deadline', default=None)
+
+def get_deadline():
+    return _deadline.get()
+
+# set while a method admitted by the box gate runs, local calls
+# made by the method share its slot rather than wait for another
+_admitted = contextvars.ContextVar('bbox_admitted', default=False)
+
 logger = logging.getLogger('bbox')
 
 def has_service(srv):
     return srv in srv_dict
 
 class MethodRef:
-    def __init__(self, fn, **kw):
+    def __init__(self, fn, executor=None, max_concurrency=None,
+                 max_queue=None, priority=None, coalesce=False,
+                 cache=None, **kw):
         self.fn = fn
+        self.executor = executor
+        self.stream = inspect.isasyncgenfunction(fn)
+        self.flights = SingleFlight() if coalesce else None
+        self.cache = None
+        self.client_ttl = None
+        if cache:
+            if cache is True:
+                cache = {}
+            unknown = set(cache) - set(CACHE_OPTIONS)
+            if unknown:
+                raise TypeError('unknown cache options {}'.format(
+                    ', '.join(sorted(unknown))))
+            self.cache = ResultCache(
+                **{k: v for k, v in cache.items()
+                   if k in ('ttl', 'max_entries', 'max_bytes')})
+            self.client_ttl = cache.get('client_ttl')
+        self.priority = parse_priority(priority)
+        if max_concurrency:
+            self.gate = Gate(limit=max_concurrency,
+                             max_queue=max_queue)
+        else:
+            self.gate = None
+
+    async def acquire(self, box_gate=True):
+        if self.gate:
+            await self.gate.acquire()
+        if not box_gate:
+            return
+        try:
+            await get_box_gate().acquire(self.priority)
+        except BaseException:
+            if self.gate:
+                self.gate.release()
+            raise
+
+    def release(self, box_gate=True):
+        if box_gate:
+            get_box_gate().release()
+        if self.gate:
+            self.gate.release()
+
+    def cache_result(self, key, res):
+        size = 0
+        if self.cache.max_bytes:
+            try:
+                size = len(key) + len(json_dumps(res))
+            except (TypeError, ValueError):
+                return
+        self.cache.put(key, res, size=size)
 
     def get_doc(self):
         return self.fn.__doc__ or ''
@@ -38,17 +154,77 @@ class Service(object):
         if srv_name in srv_dict:
             logger.warn('srv {} already exist'.format(srv_name))
         srv_dict[srv_name] = self
-
-    def method(self, name, for_test=False):
+        for name, mref in self.methods.items():
+            if mref.cache is not None:
+                mref.cache.endpoint = '/{}/{}'.format(srv_name, name)
+
+    def invalidate(self, name, *params):
+        '''
+        drop the cached result of method name called with params
+        '''
+        mref = self.methods[name]
+        key = params_key(list(params))
+        if mref.cache is not None and key is not None:
+            mref.cache.remove(key)
+
+    def clear_cache(self, name=None):
+        for mname, mref in self.methods.items():
+            if mref.cache is not None and name in (None, mname):
+                mref.cache.clear()
+
+    def method(self, name, for_test=False, executor=None,
+               max_concurrency=None, max_queue=None, priority=None,
+               coalesce=False, cache=None):
+        '''
+        executor can be 'thread' or 'process' to run a plain
+        function off the event loop, thread methods are called
+        as fn(request, *params), process methods as fn(*params)
+        since the request cannot be passed to another process.
+
+        max_concurrency limits the running calls of the method,
+        at most max_queue calls wait for a slot, more are rejected.
+        priority is 'high', 'normal' or 'low', the waiting calls of
+        higher priority are admitted first once the box reaches
+        its max_running config.
+
+        coalesce makes concurrent calls with identical params share
+        one execution.
+
+        cache is True or a dict of ttl, max_entries, max_bytes and
+        client_ttl, results are kept in a LRU keyed by params, with
+        client_ttl the response tells clients to cache it as well.
+
+        An async generator method streams its items over websocket
+        as chunk messages, other transports get them as a list
+        '''
+        if executor:
+            assert executor in (bbox_executor.THREAD,
+                                bbox_executor.PROCESS)
         def decorator(fn):
             if for_test and not testing.test_mode:
                 # this method cannot be added
                 # for non testing env
                 return fn
+            if executor and (asyncio.iscoroutinefunction(fn)
+                             or inspect.isasyncgenfunction(fn)):
+                raise TypeError(
+                    'method {} run by executor should not be a coroutine'.format(name))
+            if inspect.isasyncgenfunction(fn) and (coalesce or cache):
+                raise TypeError(
+                    'streaming method {} cannot be coalesced or cached'.format(name))
             __w = wraps(fn)(fn)
             if name in self.methods:
                 logger.warn('method {} already exist'.format(name))
-            self.methods[name] = MethodRef(__w)
+            self.methods[name] = MethodRef(
+                __w, executor=executor,
+                max_concurrency=max_concurrency,
+                max_queue=max_queue,
+                priority=priority,
+                coalesce=coalesce,
+                cache=cache)
+            if self.srv_name and self.methods[name].cache is not None:
+                self.methods[name].cache.endpoint = '/{}/{}'.format(
+                    self.srv_name, name)
             return __w
         return decorator
 
@@ -72,10 +248,30 @@ class Request:
         self.req_id = None
         self.params = None
         self.srv = None
+        self.deadline = None
+        # coroutine function to send a stream chunk message,
+        # set by transports able to stream
+        self.chunk_sender = None
+        self.streamed = False
+        # flow control of chunks, None if the client sends no credit
+        self.credit = None
+        # websocket in-flight slots held by the request
+        self.slots = None
+
+    def remaining(self):
+        '''
+        seconds left before the deadline, None if no deadline
+        '''
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
 
     async def handle(self):
-        stats_name = None
+        ep_stats = None
         try:
+            if not isinstance(self.body, dict):
+                raise ServiceError('invalid request',
+                                   'request should be an object')
             self.req_id = self.body.get('id')
             if (not isinstance(self.req_id, str) or
                 self.req_id is None):
@@ -84,6 +280,19 @@ class Request:
 
             self.params = self.body.get('params', [])
 
+            # the time budget of the caller in seconds, relative
+            # so that the clocks of hosts need not be in sync
+            timeout = self.body.get('timeout')
+            if timeout is not None:
+                if not isinstance(timeout, (int, float)):
+                    raise ServiceError('invalid timeout',
+                                       'timeout should be a number')
+                self.deadline = time.time() + timeout
+
+            credit = self.body.get('credit')
+            if isinstance(credit, int) and credit > 0:
+                self.credit = StreamCredit(credit)
+
             method = self.body['method']
             if not isinstance(method, str):
                 raise ServiceError('invalid method',
@@ -117,7 +326,9 @@ class Request:
                         'method not found',
                         'Method {} does not exist'.format(
                             self.method))
-                resp = await self.call_method(method_ref, srv_name)
+                ep_stats = stats.get_endpoint_stats(
+                    srv_name, self.method)
+                resp = await self.call_method(method_ref, ep_stats)
         except ServiceError as e:
             error_info = {
                 'message': getattr(e, 'message', str(e)),
@@ -138,9 +349,8 @@ class Request:
                           self.req_id,
                           exc_info=True)
 
-            if stats_name:
-                stats.error_rpc_request_count.incr(
-                    stats_name)
+            if ep_stats is not None:
+                ep_stats.errors.inc()
 
             error_info = {
                 'message': getattr(e, 'message', str(e)),
@@ -157,40 +367,329 @@ class Request:
                     'jsonrpc': '2.0'}
         return resp
 
-    async def call_method(self, method_ref, srv_name):
-            start_time = time.time()
-            stats_name = '/{}/{}'.format(
-                srv_name, self.method)
-            stats.rpc_request_count.incr(stats_name)
-            res = await method_ref.fn(self, *self.params)
-            resp = {'result': res,
-                    'id': self.req_id,
-                    'jsonrpc': '2.0'}
-            end_time = time.time()
-            if end_time - start_time > 1.0:
-                stats.slow_rpc_request_count.incr(stats_name)
-            return resp
+    async def call_method(self, method_ref, ep_stats):
+        start_time = time.time()
+        ep_stats.requests.inc()
+        try:
+            resp = await self.dispatch_method(method_ref)
+        finally:
+            elapsed = time.time() - start_time
+            ep_stats.latency.observe(elapsed)
+        if elapsed > 1.0:
+            ep_stats.slow.inc()
+        return resp
+
+    async def dispatch_method(self, method_ref):
+        key = None
+        if (method_ref.cache is not None
+            or method_ref.flights is not None):
+            key = params_key(self.params)
+        if key is not None and method_ref.cache is not None:
+            hit, res = method_ref.cache.get(key)
+            if hit:
+                return self.result_response(method_ref, res)
+
+        load_shedder.check()
+        load_shedder.inflight += 1
+        try:
+            if key is None or method_ref.flights is None:
+                res = await self.call_with_deadline(method_ref)
+            else:
+                res = await method_ref.flights.do(
+                    key,
+                    lambda: self.call_with_deadline(method_ref))
+        finally:
+            load_shedder.inflight -= 1
+        if key is not None and method_ref.cache is not None:
+            method_ref.cache_result(key, res)
+        return self.result_response(method_ref, res)
+
+    def result_response(self, method_ref, res):
+        resp = {'result': res,
+                'id': self.req_id,
+                'jsonrpc': '2.0'}
+        if method_ref.client_ttl:
+            # cacheability hint for clients
+            resp['cache_ttl'] = method_ref.client_ttl
+        if self.streamed:
+            # terminator of the chunk messages
+            resp['stream_end'] = True
+        return resp
 
-    async def handle_ws(self, ws):
+    async def call_with_deadline(self, method_ref):
+        timeout = self.remaining()
+        if timeout is not None and timeout <= 0:
+            raise ServiceError(DEADLINE_ERROR,
+                               'deadline exceeded before start')
+        if timeout is None:
+            res = await self.invoke_admitted(method_ref)
+        else:
+            token = _deadline.set(self.deadline)
+            try:
+                # the work is cancelled once the deadline passes
+                res = await asyncio.wait_for(
+                    self.invoke_guarded(method_ref),
+                    timeout)
+            except MethodTimeout as e:
+                # raised by the method, e.g. by a nested rpc
+                raise e.__cause__
+            except asyncio.TimeoutError:
+                raise ServiceError(DEADLINE_ERROR,
+                                   'deadline exceeded')
+            finally:
+                _deadline.reset(token)
+        return res
+
+    async def invoke_guarded(self, method_ref):
+        '''
+        tell timeouts of the method from the deadline timeout
+        '''
+        try:
+            return await self.invoke_admitted(method_ref)
+        except asyncio.TimeoutError as e:
+            raise MethodTimeout() from e
+
+    async def invoke_admitted(self, method_ref):
+        # nested local calls would deadlock on a full box gate
+        box_gate = not _admitted.get()
+        await method_ref.acquire(box_gate)
+        token = _admitted.set(True)
+        try:
+            return await self.invoke(method_ref)
+        finally:
+            _admitted.reset(token)
+            method_ref.release(box_gate)
+
+    async def invoke(self, method_ref):
+        if method_ref.stream:
+            return await self.invoke_stream(method_ref)
+        elif method_ref.executor == bbox_executor.PROCESS:
+            return await bbox_executor.run_in_executor(
+                method_ref.executor, method_ref.fn, *self.params)
+        elif method_ref.executor:
+            return await bbox_executor.run_in_executor(
+                method_ref.executor, method_ref.fn,
+                self, *self.params)
+        else:
+            return await method_ref.fn(self, *self.params)
+
+    async def invoke_stream(self, method_ref):
+        agen = method_ref.fn(self, *self.params)
+        if self.chunk_sender is None:
+            return [item async for item in agen]
+
+        cnt = 0
+        async for item in agen:
+            if self.credit is not None:
+                await self.wait_credit()
+            await self.chunk_sender({
+                'jsonrpc': '2.0',
+                'id': self.req_id,
+                'chunk': item})
+            cnt += 1
+        self.streamed = True
+        return cnt
+
+    async def wait_credit(self):
+        if self.credit.n > 0 or self.slots is None:
+            await self.credit.acquire()
+            return
+        # the client may be slow, do not hold in-flight slots
+        # while waiting for it
+        self.slots.release()
+        await self.credit.acquire()
+        await self.slots.acquire()
+
+    async def handle_ws(self, ws, codec=json_codec):
+        async def send_chunk(msg):
+            await send_ws(ws, codec, msg)
+        if isinstance(self.body, dict) and (
+                self.body.get('credit') or self.body.get('stream')):
+            # stream only to clients asking for it, others get
+            # the items as a list like HTTP clients
+            self.chunk_sender = send_chunk
         resp = await self.handle()
         if resp:
-            await ws.send_json(resp)
+            await send_ws(ws, codec, resp)
         return resp
 
+async def handle_batch(bodies):
+    '''
+    handle a JSON-RPC batch, the requests are run concurrently
+    '''
+    if not bodies:
+        return {'jsonrpc': '2.0',
+                'id': None,
+                'error': {'code': 'invalid request',
+                          'message': 'empty batch'}}
+    reqs = [Request(body) for body in bodies]
+    return await asyncio.gather(*[req.handle() for req in reqs])
+
+async def handle_batch_ws(bodies, ws, codec=json_codec):
+    resp = await handle_batch(bodies)
+    await send_ws(ws, codec, resp)
+    return resp
+
 async def handle(request):
-    body = await request.json()
-    req = Request(body)
-    resp = await req.handle()
-    return web.json_response(resp)
+    codec = get_codec_by_content_type(request.content_type)
+    body = codec.loads(await request.read())
+    if isinstance(body, list):
+        resp = await handle_batch(body)
+    else:
+        req = Request(body)
+        resp = await req.handle()
+    return web.Response(body=encode_body(codec, resp),
+                        content_type=codec.content_type)
+
+def error_response(body, code, message):
+    if isinstance(body, list):
+        return [error_response(b, code, message) for b in body]
+    req_id = body.get('id') if isinstance(body, dict) else None
+    return {'jsonrpc': '2.0',
+            'id': req_id,
+            'error': {'code': code,
+                      'message': message}}
+
+def busy_response(body):
+    return error_response(body, BUSY_ERROR,
+                          'too many requests in flight')
+
+def get_box_semaphore():
+    global _box_semaphore, _box_limit, _box_batch_lock
+    if _box_semaphore is None:
+        _box_limit = get_box().get_box_config(
+            'box_max_inflight', BOX_MAX_INFLIGHT)
+        _box_semaphore = asyncio.Semaphore(_box_limit)
+        _box_batch_lock = asyncio.Lock()
+    return _box_semaphore
+
+async def acquire_slots(sem, n):
+    for i in range(n):
+        try:
+            await sem.acquire()
+        except BaseException:
+            for _ in range(i):
+                sem.release()
+            raise
+
+class Slots:
+    '''
+    in-flight slots of a websocket message on the connection
+    and the box, a batch takes a slot per call
+    '''
+    def __init__(self, conn_sem, box_sem, n):
+        self.conn_sem = conn_sem
+        self.box_sem = box_sem
+        self.n = n
+        self.held = False
+
+    async def acquire(self):
+        await acquire_slots(self.conn_sem, self.n)
+        try:
+            if self.n > 1:
+                # one batch at a time takes several box slots,
+                # so partial holders cannot starve each other
+                async with _box_batch_lock:
+                    await acquire_slots(self.box_sem, self.n)
+            else:
+                await self.box_sem.acquire()
+        except BaseException:
+            for _ in range(self.n):
+                self.conn_sem.release()
+            raise
+        self.held = True
+
+    def release(self, fut=None):
+        if self.held:
+            self.held = False
+            for _ in range(self.n):
+                self.conn_sem.release()
+                self.box_sem.release()
 
 async def handle_ws(request):
-    ws = web.WebSocketResponse(autoping=True)
+    ws = web.WebSocketResponse(autoping=True,
+                               protocols=box_ws_protocols())
     await ws.prepare(request)
+    codec = get_codec_by_protocol(ws.ws_protocol)
 
-    async for req_msg in ws:
-        body = json.loads(req_msg.data)
-        req = Request(body)
-        asyncio.ensure_future(req.handle_ws(ws))
+    curr_box = get_box()
+    conn_limit = curr_box.get_box_config(
+        'ws_max_inflight', WS_MAX_INFLIGHT)
+    conn_sem = asyncio.Semaphore(conn_limit)
+    box_sem = get_box_semaphore()
+    # a batch takes a slot per call, larger batches never fit
+    max_batch = min(conn_limit, _box_limit)
+    reject_on_busy = curr_box.get_box_config('reject_on_busy', False)
+
+    # req_id -> (request, task) of flow controlled streams
+    streams = {}
+
+    open_ws.inc()
+    try:
+        async for req_msg in ws:
+            body = codec.loads(req_msg.data)
+            if not isinstance(body, (dict, list)):
+                await send_ws(ws, codec, error_response(
+                    body, 'invalid request',
+                    'request should be an object or a batch'))
+                continue
+            if isinstance(body, dict) and 'method' not in body:
+                # credit or cancel of a stream
+                handle_stream_control(streams, body)
+                continue
+            if reject_on_busy and (conn_sem.locked() or box_sem.locked()):
+                await send_ws(ws, codec, busy_response(body))
+                continue
+
+            nslots = 1
+            if isinstance(body, list):
+                if len(body) > max_batch:
+                    await send_ws(ws, codec, error_response(
+                        body, BATCH_TOO_LARGE,
+                        'batch larger than {}'.format(max_batch)))
+                    continue
+                nslots = max(1, len(body))
+
+            # stop reading from the socket until slots are free,
+            # streams waiting for credit give up their slots so
+            # that the credit messages are still read
+            slots = Slots(conn_sem, box_sem, nslots)
+            await slots.acquire()
+            try:
+                if isinstance(body, list):
+                    fut = asyncio.ensure_future(
+                        handle_batch_ws(body, ws, codec))
+                else:
+                    req = Request(body)
+                    req.slots = slots
+                    fut = asyncio.ensure_future(req.handle_ws(ws, codec))
+                    if body.get('credit'):
+                        req_id = body.get('id')
+                        streams[req_id] = (req, fut)
+                        fut.add_done_callback(
+                            lambda f, req_id=req_id: streams.pop(req_id, None))
+            except BaseException:
+                slots.release()
+                raise
+            fut.add_done_callback(slots.release)
+    finally:
+        open_ws.dec()
+        # nobody reads the streams any more
+        for req, fut in list(streams.values()):
+            fut.cancel()
+
+def handle_stream_control(streams, body):
+    entry = streams.get(body.get('id'))
+    if entry is None:
+        return
+    req, fut = entry
+    if body.get('cancel'):
+        fut.cancel()
+    else:
+        credit = body.get('credit')
+        if (req.credit is not None and isinstance(credit, int)
+            and credit > 0):
+            req.credit.grant(credit)
 
 async def index(request):
     return web.Response(text='hello')
@@ -200,7 +699,7 @@ async def handle_metrics_json(request):
     box = get_box()
     for name, labels, v in resp['lines']:
         labels['box'] = box.boxid
-    return web.json_response(resp)
+    return web.json_response(resp, dumps=json_dumps)
 
 async def handle_metrics(request):
     '''
@@ -230,7 +729,19 @@ async def start_server(args):
     srv_names = list(srv_dict.keys())
     curr_box = get_box()
     curr_box.ssl_prefix = args.ssl
-    await curr_box.start(boxid, srv_names)
+    worker_bind = getattr(args, 'worker_bind', None)
+    if worker_bind:
+        # workers share the port of the box
+        curr_box.attach(boxid, srv_names, worker_bind)
+    else:
+        await curr_box.start(boxid, srv_names)
+
+    load_shedder.configure(curr_box)
+    load_shedder.start()
+
+    metrics_pusher.configure(curr_box)
+    metrics_pusher.start()
+    box_monitor.start()
 
     app = web.Application()
     app.router.add_post('/jsonrpc/2.0/api', handle)
@@ -249,5 +760,6 @@ async def start_server(args):
     loop = asyncio.get_event_loop()
     srv = await loop.create_server(handler,
                                    host, port,
-                                   ssl=ssl_context)
+                                   ssl=ssl_context,
+                                   reuse_port=bool(worker_bind))
     return srv, handler
@@ -11,6 +11,7 @@ from aiobbox.utils import parse_method
 from aiobbox.client import pool
 from aiobbox.exceptions import ConnectionError
 from aiobbox.handler import BaseHandler
+from aiobbox.codec import json_dumps, json_loads
 
 logger = logging.getLogger('bbox')
 
@@ -18,7 +19,7 @@ _whitelist = None
 
 # proxy server
 async def handle_rpc(request):
-    body = await request.json()
+    body = await request.json(loads=json_loads)
     if ('method' not in body
         or not isinstance(body['method'], str)):
         logger.warn('bad request for for body %s', body)
@@ -56,7 +57,7 @@ async def handle_rpc(request):
     except ConnectionError:
         logger.warn('connect error on request srv %s, method %s', srv, method, exc_info=True)
         return web.HTTPBadGateway()
-    return web.json_response(r)
+    return web.json_response(r, dumps=json_dumps)
 
 class Handler(BaseHandler):
     async def get_app(self, args):
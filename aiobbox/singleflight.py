@@ -0,0 +1,35 @@
+import asyncio
+from aiobbox.codec import json_dumps
+
+class SingleFlight:
+    '''
+    concurrent calls of the same key share one execution
+    '''
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        '''
+        fn is a function returning a coroutine, it is called only
+        if no call of key is in flight
+        '''
+        fut = self.calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self.calls[key] = fut
+
+            def done(f):
+                if self.calls.get(key) is f:
+                    del self.calls[key]
+            fut.add_done_callback(done)
+        # a cancelled caller leaves the execution to the others
+        return await asyncio.shield(fut)
+
+def params_key(params):
+    '''
+    the coalescing key of params, None if they cannot be encoded
+    '''
+    try:
+        return json_dumps(params, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
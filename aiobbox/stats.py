@@ -1,43 +1,146 @@
-from collections import defaultdict
-from aiobbox.metrics import add_metrics
+from bisect import bisect_left
+from aiobbox.metrics import add_metrics, Counter
 
-class RPCRequestCount:
+# upper bounds in seconds of latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RPCRequestCount(Counter):
+    labelnames = ('endpoint',)
+
+    def incr(self, endpoint, v=1):
+        self.labels(endpoint).inc(v)
+
+    def setv(self, endpoint, v):
+        self.labels(endpoint).set(v)
+
+class Histogram:
+    '''
+    counts of values in fixed buckets, histograms of the same
+    buckets merge by adding up counts
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is of the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def merge(self, other):
+        assert self.buckets == other.buckets
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative(self):
+        '''
+        (le, count of values <= le) pairs of prometheus histogram
+        '''
+        arr = []
+        acc = 0
+        for bound, c in zip(self.buckets, self.counts):
+            acc += c
+            arr.append(('{:g}'.format(bound), acc))
+        arr.append(('+Inf', self.count))
+        return arr
+
+class HistogramMetric:
+    '''
+    histograms per value of one label or a single histogram if
+    labelname is None, values are cumulative since the box
+    started so scrapes do not interfere
+    '''
     name = None
     help = None
-    type = 'gauge'
+    type = 'histogram'
+    labelname = None
 
-    def __init__(self, name, help=''):
+    def __init__(self, name, help='', labelname=None,
+                 buckets=LATENCY_BUCKETS):
         self.name = name
         if not help:
             self.help = self.name.replace('_', ' ')
         else:
             self.help = help
-        self.values = defaultdict(int)
+        if labelname:
+            self.labelname = labelname
+        self.buckets = buckets
+        self.values = {}
 
-    def incr(self, endpoint, v=1):
-        self.values[endpoint] += v
+    def labels(self, value=None):
+        h = self.values.get(value)
+        if h is None:
+            h = Histogram(self.buckets)
+            self.values[value] = h
+        return h
 
-    def setv(self, endpoint, v):
-        self.values[endpoint] = v
+    def observe(self, value, v):
+        self.labels(value).observe(v)
 
     async def collect(self):
-        arr = [({'endpoint': k}, v)
-               for k, v in self.values.items()]
-        # clear old value
-        self.values = defaultdict(int)
+        arr = []
+        for value, h in self.values.items():
+            if self.labelname:
+                labels = {self.labelname: value}
+            else:
+                labels = {}
+            for le, c in h.cumulative():
+                arr.append(('_bucket', dict(labels, le=le), c))
+            arr.append(('_sum', dict(labels), h.sum))
+            arr.append(('_count', dict(labels), h.count))
         return arr
 
+class RPCLatency(HistogramMetric):
+    '''
+    latency histogram per endpoint
+    '''
+    labelname = 'endpoint'
+
 rpc_request_count = RPCRequestCount(
     'rpc_requests',
-    help='RPC request count since last time')
+    help='RPC request count')
 add_metrics(rpc_request_count)
 
 slow_rpc_request_count = RPCRequestCount(
     'slow_rpc_requests',
-    help='Slow RPC request count since last time')
+    help='Slow RPC request count')
 add_metrics(slow_rpc_request_count)
 
 error_rpc_request_count = RPCRequestCount(
     'error_rpc_requests',
-    help='Error RPC request count since last time')
+    help='Error RPC request count')
 add_metrics(error_rpc_request_count)
+
+rpc_latency = RPCLatency(
+    'rpc_request_duration_seconds',
+    help='RPC request latency in seconds')
+add_metrics(rpc_latency)
+
+class EndpointStats:
+    '''
+    metric children of an endpoint bound once, so a request
+    does not build label sets
+    '''
+    __slots__ = ('requests', 'slow', 'errors', 'latency')
+
+    def __init__(self, endpoint):
+        self.requests = rpc_request_count.labels(endpoint)
+        self.slow = slow_rpc_request_count.labels(endpoint)
+        self.errors = error_rpc_request_count.labels(endpoint)
+        self.latency = rpc_latency.labels(endpoint)
+
+_endpoint_stats = {}
+
+def get_endpoint_stats(srv_name, method):
+    key = (srv_name, method)
+    ep_stats = _endpoint_stats.get(key)
+    if ep_stats is None:
+        ep_stats = EndpointStats('/{}/{}'.format(srv_name, method))
+        _endpoint_stats[key] = ep_stats
+    return ep_stats
@@ -0,0 +1,25 @@
+'''
+sub commands of bbox.py
+'''
+
+# (sub command, tool module, help), the tool module is
+# imported only when its sub command is selected
+COMMANDS = [
+    ('init', 'aiobbox.tools.initprj', 'init a bbox project folder'),
+    ('start', 'aiobbox.tools.startbox', 'start bbox python project'),
+    ('httpd', 'aiobbox.tools.starthttpd', 'start bbox python httpd'),
+    ('run', 'aiobbox.tools.runtask', 'run bbox tasks'),
+    ('rpc', 'aiobbox.tools.rpcclient', 'test an rpc interface'),
+    ('config', 'aiobbox.tools.clusterconfig', 'bbox config'),
+    ('cluster', 'aiobbox.tools.clusterop', 'bbox cluster'),
+    ('lock', 'aiobbox.tools.watchlock', 'acquire a lock and execute'),
+    ('printticket', 'aiobbox.tools.printticket', 'print ticket info'),
+    ('doc', 'aiobbox.tools.printdoc', 'print human readable documents'),
+    ('metrics', 'aiobbox.tools.metrics', 'aggregate metrics of boxes'),
+    ]
+
+def command_help(mod_name):
+    for _, name, help_msg in COMMANDS:
+        if name == mod_name:
+            return help_msg
+    raise KeyError(mod_name)
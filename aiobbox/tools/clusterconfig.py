@@ -7,6 +7,7 @@ import aiobbox.client as bbox_client
 from aiobbox.cluster import get_cluster, get_sharedconfig
 from aiobbox.utils import guess_json, json_pp
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 async def get_config(args):
     sec_key = args.sec_key
@@ -54,7 +55,7 @@ async def load_config(args):
         await get_cluster().set_config(sec, key, value)
 
 class Handler(BaseHandler):
-    help = 'bbox config'
+    help = command_help(__name__)
     def add_arguments(self, parser):
         subp = parser.add_subparsers()
         p = subp.add_parser('get', help='get config')
@@ -105,7 +106,9 @@ class Handler(BaseHandler):
         p.set_defaults(func=del_config)
 
     async def run(self, args):
-        await get_cluster().start()
+        # config changes are compared to etcd values,
+        # do not start from a stale snapshot
+        await get_cluster().start(use_snapshot=False)
         func = getattr(args, 'func', None)
         if func:
             try:
@@ -6,6 +6,7 @@ import aiobbox.client as bbox_client
 from aiobbox.utils import guess_json, json_pp
 from aiobbox.cluster import get_cluster, get_ticket
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 parser = argparse.ArgumentParser(
     prog='bbox cluster')
@@ -20,7 +21,7 @@ async def cluster_info(args):
     print(json_pp(info))
 
 class Handler(BaseHandler):
-    help = 'bbox cluster'
+    help = command_help(__name__)
     def add_arguments(self, parser):
         subp = parser.add_subparsers()
         p = subp.add_parser('info')
@@ -9,11 +9,12 @@ from aiobbox.cluster import get_box, get_cluster
 from aiobbox.cluster import get_ticket
 from aiobbox.utils import import_module, get_ssl_context
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 logger = logging.getLogger('bbox')
 
 class Handler(BaseHandler):
-    help = 'start bbox python httpd'
+    help = command_help('aiobbox.tools.starthttpd')
     run_forever = True
     mod_handle = None
     def add_arguments(self, parser):
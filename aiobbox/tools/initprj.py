@@ -3,9 +3,10 @@ import uuid
 import json
 import argparse
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 class Handler(BaseHandler):
-    help = 'init a bbox project folder'
+    help = command_help(__name__)
 
     def add_arguments(self, parser):
         parser.add_argument(
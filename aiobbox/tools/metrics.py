@@ -3,20 +3,25 @@ import ssl
 import logging
 import uuid
 import json
+import time
 import asyncio
 from urllib.parse import urljoin
 from aiohttp import (
     web,
-    ClientSession,
-    ClientConnectionError)
+    ClientError)
 
 import argparse
 import aiobbox.server as bbox_server
 from aiobbox.cluster import get_box, get_cluster
-from aiobbox.cluster import get_ticket
+from aiobbox.cluster import get_ticket, get_sharedconfig
 from aiobbox.utils import import_module, abs_path
 from aiobbox.client import HttpClient
+from aiobbox.codec import json_loads
 from aiobbox.metrics import collect_cluster_metrics, report_box_failure
+from aiobbox.metrics import PUSH_SRV, labels_key
+from aiobbox.server import Service
+from aiobbox.singleflight import SingleFlight
+from aiobbox.tools import command_help
 
 from .httpbase import Handler as HttpdHandler
 
@@ -27,69 +32,261 @@ collect_localbox = False
 
 bearer_token = None
 
+# seconds to wait for the metrics of one box
+box_timeout = 3
+# max boxes fetched at the same time
+concurrency = 50
+# seconds the rendered body is reused by following scrapes
+cache_ttl = 5
+# seconds between background renders, 0 to render on scrape
+refresh_interval = 0
+# seconds a box is served from pushes after its last push
+push_ttl = 120
+
 _http_clients = {}
+_fetch_sem = None
+_flights = SingleFlight()
+# (expire time, sequence, metrics of polled boxes)
+_polled = (0, 0, None)
+# ((polled sequence, push version), rendered body)
+_rendered = (None, None)
+# boxid -> PushedBox
+_pushed_boxes = {}
+_push_version = 0
 
-async def get_box_metrics(connect):
-    if connect not in _http_clients:
-        client = HttpClient(connect)
-        _http_clients[connect] = client
-    else:
-        client = _http_clients[connect]
-    try:
-        url = urljoin(client.url_prefix, '/metrics.json')
-        resp = await client.session.get(url)
-    except ClientConnectionError:
-        logger.error('client connection error to %s', connect, exc_info=True)
-        return report_box_failure(connect)
-    return await resp.json()
+class PushedBox:
+    '''
+    cumulative series of a box, merged from the deltas between
+    the cumulative values pushed by each of its processes. Gauges
+    are kept per process under the worker label
+    '''
+    def __init__(self, boxid):
+        self.boxid = boxid
+        self.meta = {}
+        self.counters = {}
+        # instance -> [last seq, last values, last push time, gauges]
+        self.instances = {}
+        self.last_push = 0
 
-async def handle_metrics(request):
-    # check bearer token
-    if bearer_token:
-        if (request.headers.get('Authorization')
-            != 'Bearer {}'.format(bearer_token)):
-            raise web.HTTPUnauthorized()
+    def merge(self, data):
+        '''
+        return False for a push already merged or out of order
+        '''
+        now = time.time()
+        state = self.instances.get(data['instance'])
+        if state is None:
+            state = [0, {}, now, []]
+            self.instances[data['instance']] = state
+        elif data['seq'] <= state[0]:
+            return False
+        state[0] = data['seq']
+        state[2] = now
+        last_values = state[1]
 
-    c = get_cluster()
-    with ClientSession() as session:
-        if collect_localbox:
-            fns = [get_box_metrics(bind)
-                   for bind in c.get_local_boxes()]
-        else:
-            fns = [get_box_metrics(bind)
-                   for bind in c.boxes.keys()]
-        if fns:
-            res = await asyncio.gather(*fns)
+        self.meta.update(data['meta'])
+        for name, labels, v in data['counters']:
+            key = (name, labels_key(labels))
+            prev = last_values.get(key, 0)
+            last_values[key] = v
+            delta = v - prev
+            if delta < 0:
+                # the series restarted
+                delta = v
+            series = self.counters.get(key)
+            if series is None:
+                labels = dict(labels, box=self.boxid)
+                self.counters[key] = [name, labels, delta]
+            else:
+                series[2] += delta
+        state[3] = [(name,
+                     dict(labels, box=self.boxid,
+                          worker=data['instance']),
+                     v)
+                    for name, labels, v in data['gauges']]
+        self.last_push = now
+        return True
+
+    def expire_instances(self, expire_time):
+        '''
+        return True if an instance expired with its gauges
+        '''
+        expired = False
+        for instance, state in list(self.instances.items()):
+            if state[2] < expire_time:
+                del self.instances[instance]
+                expired = True
+        return expired
+
+    def get_metrics(self):
+        lines = [tuple(series) for series in self.counters.values()]
+        for state in self.instances.values():
+            lines.extend(state[3])
+        return {
+            'meta': self.meta,
+            'lines': lines
+            }
+
+srv = Service()
+
+@srv.method('push')
+async def push(request, boxid, data):
+    '''
+    push(boxid, data)
+    merge metrics pushed by a box
+    '''
+    global _push_version
+    pushed_box = _pushed_boxes.get(boxid)
+    if pushed_box is None:
+        pushed_box = PushedBox(boxid)
+        _pushed_boxes[boxid] = pushed_box
+    if pushed_box.merge(data):
+        _push_version += 1
+    return 'ok'
+
+def expire_pushed_boxes():
+    global _push_version
+    expire_time = time.time() - push_ttl
+    for boxid, pushed_box in list(_pushed_boxes.items()):
+        if pushed_box.last_push < expire_time:
+            del _pushed_boxes[boxid]
+            _push_version += 1
+        elif pushed_box.expire_instances(expire_time):
+            _push_version += 1
+
+def box_pushes(boxid):
+    '''
+    boxes with metrics_push_interval push to one of the metrics
+    daemons and are never polled
+    '''
+    return get_sharedconfig().get_chain(
+        ['box.{}'.format(boxid), 'box.default'],
+        'metrics_push_interval',
+        default=0)
+
+async def fetch_box_metrics(connect):
+    async with _fetch_sem:
+        if connect not in _http_clients:
+            client = HttpClient(connect)
+            _http_clients[connect] = client
         else:
-            res = []
+            client = _http_clients[connect]
+        url = urljoin(client.url_prefix, '/metrics.json')
+        async with client.session.get(url) as resp:
+            return await resp.json(loads=json_loads)
 
-    if export_cluster:
-        res.append(collect_cluster_metrics())
+async def get_box_metrics(connect):
+    try:
+        # the timeout covers waiting for a fetch slot too
+        return await asyncio.wait_for(
+            fetch_box_metrics(connect), box_timeout)
+    except asyncio.TimeoutError:
+        logger.error('metrics of %s timeout', connect)
+        return report_box_failure(connect)
+    except (ClientError, KeyError, ValueError):
+        logger.error('client connection error to %s',
+                     connect, exc_info=True)
+        return report_box_failure(connect)
+
+def prune_http_clients(binds):
+    for connect in list(_http_clients.keys()):
+        if connect not in binds:
+            client = _http_clients.pop(connect)
+            client.session.close()
 
+def render_metrics(res):
     meta = {}
     lines = []
-    meta_lines = []
     for resp in res:
         meta.update(resp['meta'])
-
         for name, labels, v in resp['lines']:
             d = ', '.join('{}="{}"'.format(lname, lvalue)
                           for lname, lvalue in labels.items())
-            d = '{' + d + '}'
-            lines.append('{} {} {}'.format(name, d, v))
+            lines.append('%s {%s} %s' % (name, d, v))
 
+    meta_lines = []
     for name, define in meta.items():
         meta_lines.append('# HELP {} {}'.format(
             name, define['help']))
         meta_lines.append('# TYPE {} {}'.format(
             name, define['type']))
     meta_lines.append('')
+    return '\n'.join(meta_lines + lines + [''])
+
+async def collect_all():
+    '''
+    fetch the metrics of boxes not pushing their metrics
+    '''
+    global _polled
+    c = get_cluster()
+    if collect_localbox:
+        binds = c.get_local_boxes()
+    else:
+        binds = list(c.boxes.keys())
+    prune_http_clients(c.boxes)
+    expire_pushed_boxes()
+    binds = [bind for bind in binds
+             if not box_pushes(c.boxes.get(bind, {}).get('boxid'))]
+
+    if binds:
+        res = await asyncio.gather(
+            *[get_box_metrics(bind) for bind in binds])
+    else:
+        res = []
+
+    if export_cluster:
+        res.append(collect_cluster_metrics())
+
+    _polled = (time.time() + cache_ttl, _polled[1] + 1, res)
+
+def render_ready():
+    '''
+    the exposition text of polled and pushed metrics, it is
+    rendered again only when either changed
+    '''
+    global _rendered
+    expire_pushed_boxes()
+    _, seq, res = _polled
+    version = (seq, _push_version)
+    rendered_version, body = _rendered
+    if version != rendered_version:
+        res = res + [pushed_box.get_metrics()
+                     for pushed_box in _pushed_boxes.values()]
+        body = render_metrics(res)
+        _rendered = (version, body)
+    return body
+
+async def get_rendered():
+    expire_time, _, res = _polled
+    if res is None or (refresh_interval <= 0
+                       and expire_time <= time.time()):
+        # concurrent scrapes share one fan out
+        await _flights.do('metrics', collect_all)
+    return render_ready()
 
+async def refresh_loop():
+    while True:
+        try:
+            # scrapes before the first refresh join this fan out
+            await _flights.do('metrics', collect_all)
+            render_ready()
+        except Exception:
+            logger.error('fail to collect metrics', exc_info=True)
+        await asyncio.sleep(refresh_interval)
+
+async def handle_metrics(request):
+    # check bearer token
+    if bearer_token:
+        if (request.headers.get('Authorization')
+            != 'Bearer {}'.format(bearer_token)):
+            raise web.HTTPUnauthorized()
+
+    body = await get_rendered()
     headers = {'Content-Type': 'text/plain'}
-    return web.Response(text='\n'.join(meta_lines + lines + ['']),
-                        headers=headers)
+    return web.Response(text=body, headers=headers)
 
 class Handler(HttpdHandler):
+    help = command_help(__name__)
+
     def add_arguments(self, parser):
         super(Handler, self).add_arguments(parser)
 
@@ -107,8 +304,35 @@ class Handler(HttpdHandler):
             '--bearer_token',
             type=str,
             help='bearer token')
+        parser.add_argument(
+            '--box_timeout',
+            type=float,
+            default=box_timeout,
+            help='seconds to wait for the metrics of a box')
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=concurrency,
+            help='max boxes fetched at the same time')
+        parser.add_argument(
+            '--cache_ttl',
+            type=float,
+            default=cache_ttl,
+            help='seconds the metrics are reused by scrapes')
+        parser.add_argument(
+            '--refresh_interval',
+            type=float,
+            default=refresh_interval,
+            help='collect metrics in background every x seconds, 0 to collect on scrape')
+        parser.add_argument(
+            '--push_ttl',
+            type=float,
+            default=push_ttl,
+            help='seconds pushed metrics of a box are kept after its last push')
 
     async def get_app(self, args):
+        # boxes with metrics_push_interval push to this service
+        srv.register(PUSH_SRV)
         app = web.Application()
         app.router.add_get('/metrics', handle_metrics)
         app.router.add_get('/', handle_metrics)
@@ -116,6 +340,17 @@ class Handler(HttpdHandler):
 
     async def start(self, args):
         global export_cluster, collect_localbox, bearer_token
+        global box_timeout, concurrency, cache_ttl, refresh_interval
+        global push_ttl
+        global _fetch_sem
         export_cluster = args.export_cluster
         collect_localbox = args.collect_localbox
         bearer_token = args.bearer_token
+        box_timeout = args.box_timeout
+        concurrency = args.concurrency
+        cache_ttl = args.cache_ttl
+        refresh_interval = args.refresh_interval
+        push_ttl = args.push_ttl
+        _fetch_sem = asyncio.Semaphore(concurrency)
+        if refresh_interval > 0:
+            asyncio.ensure_future(refresh_loop())
@@ -7,6 +7,7 @@ import aiobbox.client as bbox_client
 from aiobbox.cluster import get_cluster
 from aiobbox.utils import guess_json, json_pp, json_to_str
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 
 def handle_text(text, indent=0, prompt=''):
@@ -50,7 +51,7 @@ def print_markdown(r):
         print()
 
 class Handler(BaseHandler):
-    help = 'print human readable documents'
+    help = command_help(__name__)
     def add_arguments(self, parser):
         parser.add_argument(
             'srv_name',
@@ -3,9 +3,10 @@ import json
 import argparse
 from aiobbox.cluster import get_ticket
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 class Handler(BaseHandler):
-    help = 'print ticket info'
+    help = command_help(__name__)
     def add_arguments(self, parser):
         parser.add_argument(
             'key',
@@ -6,10 +6,12 @@ import argparse
 import aiobbox.client as bbox_client
 from aiobbox.cluster import get_cluster
 from aiobbox.utils import guess_json, json_pp, json_to_str
+from aiobbox.codec import codec_names
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 class Handler(BaseHandler):
-    help = 'test an rpc interface'
+    help = command_help(__name__)
     def add_arguments(self, parser):
         parser.add_argument(
             'srv_method',
@@ -50,7 +52,15 @@ class Handler(BaseHandler):
             '--dispatch_policy',
             type=str,
             default='first',
-            help='dispatch request to clients')
+            choices=sorted(bbox_client.FullConnectPool.policy_names),
+            help='dispatch request to clients, first, random, least or p2c')
+
+        parser.add_argument(
+            '--codec',
+            type=str,
+            default='',
+            choices=codec_names(),
+            help='wire codec, json, msgpack or cbor if installed')
 
         parser.add_argument(
             '--stack',
@@ -63,8 +73,10 @@ class Handler(BaseHandler):
 
         ps = [guess_json(p) for p in args.param]
 
-        if args.dispatch_policy == 'random':
-            bbox_client.pool.policy = bbox_client.pool.RANDOM
+        bbox_client.pool.set_policy(args.dispatch_policy)
+
+        if args.codec:
+            bbox_client.pool.set_codec(args.codec)
 
         try:
             await get_cluster().start()
@@ -10,11 +10,12 @@ import aiobbox.server as bbox_server
 from aiobbox.cluster import get_box, get_cluster, get_ticket
 from aiobbox.utils import import_module
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 logger = logging.getLogger('bbox')
 
 class Handler(BaseHandler):
-    help = 'run bbox tasks'
+    help = command_help(__name__)
     def add_arguments(self, parser):
         parser.add_argument(
             'module',
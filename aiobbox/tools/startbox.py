@@ -1,17 +1,76 @@
 import os, sys
+import signal
 import logging
 import uuid
 import json
 import asyncio
 import argparse
 import aiobbox.server as bbox_server
+from aiobbox.server import srv_dict
 from aiobbox.cluster import get_box, get_cluster
 from aiobbox.cluster import get_ticket
 from aiobbox.utils import import_module
 from aiobbox.handler import BaseHandler
+from aiobbox.executor import shutdown_executors
+from aiobbox.tools import command_help
+
+logger = logging.getLogger('bbox')
+
+# seconds to wait before restarting a dead worker
+WORKER_RESTART_DELAY = 1.0
+
+# seconds for workers to finish pending requests on shutdown
+WORKER_DRAIN_SECS = 10.0
+
+class WorkerSupervisor:
+    '''
+    run box workers as child processes sharing the box port
+    through SO_REUSEPORT, dead workers are restarted
+    '''
+    def __init__(self, nworkers, cmd):
+        self.nworkers = nworkers
+        self.cmd = cmd
+        self.procs = {}
+        self.cont = True
+
+    def start(self):
+        for idx in range(self.nworkers):
+            asyncio.ensure_future(self.run_worker(idx))
+
+    async def run_worker(self, idx):
+        while self.cont:
+            proc = await asyncio.create_subprocess_exec(*self.cmd)
+            self.procs[idx] = proc
+            logger.info('worker %s started, pid %s', idx, proc.pid)
+            code = await proc.wait()
+            if not self.cont:
+                break
+            logger.warn('worker %s exited with code %s, restart',
+                        idx, code)
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def stop(self, timeout=WORKER_DRAIN_SECS):
+        self.cont = False
+        procs = [proc for proc in self.procs.values()
+                 if proc.returncode is None]
+        for proc in procs:
+            try:
+                proc.send_signal(signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if not procs:
+            return
+        _, pending = await asyncio.wait(
+            [asyncio.ensure_future(proc.wait()) for proc in procs],
+            timeout=timeout)
+        if pending:
+            logger.warn('kill %s workers not drained', len(pending))
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
 
 class Handler(BaseHandler):
-    help = 'start bbox python project'
+    help = command_help(__name__)
     run_forever = True
 
     def add_arguments(self, parser):
@@ -39,6 +98,19 @@ class Handler(BaseHandler):
             default=3600 * 24,  # one day
             help='time to live')
 
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=0,
+            help='number of worker processes sharing the box port, 0 to serve in this process. workers shed load on their own but the overload state is not published to etcd in this mode')
+
+        # set by the supervisor for worker processes
+        parser.add_argument(
+            '--worker_bind',
+            type=str,
+            default='',
+            help=argparse.SUPPRESS)
+
     async def run(self, args):
         cfg = get_ticket()
         if cfg.language != 'python3':
@@ -57,20 +129,90 @@ class Handler(BaseHandler):
             else:
                 mod_handlers.append(BaseHandler())
 
+        self.mod_handlers = []
+        self.supervisor = None
+        self.srv = None
+        self.handler = None
+        if args.workers > 0 and not args.worker_bind:
+            return await self.run_supervisor(args)
+
         # start cluster client
         await get_cluster().start()
-        src, handler = await bbox_server.start_server(args)
+        srv, handler = await bbox_server.start_server(args)
 
         for h in mod_handlers:
             await h.start(args)
+        self.srv = srv
         self.handler = handler
         self.mod_handlers = mod_handlers
 
+        if args.worker_bind:
+            # the supervisor stops workers, they have no ttl
+            loop = asyncio.get_event_loop()
+            loop.add_signal_handler(
+                signal.SIGTERM,
+                lambda: asyncio.ensure_future(self.drain()))
+        else:
+            asyncio.ensure_future(self.wait_ttl(args.ttl))
+
+    async def run_supervisor(self, args):
+        # register the box once, the workers serve it. The load
+        # shedder runs in each worker, the supervisor does not see
+        # worker load so box_info never reports the box overloaded
+
+        # the box config, port_range etc., comes from the cluster
+        await get_cluster().start()
+        curr_box = get_box()
+        curr_box.ssl_prefix = args.ssl
+        await curr_box.start(args.boxid, list(srv_dict.keys()))
+
+        cmd = [sys.executable, sys.argv[0], 'start']
+        cmd.extend(args.module)
+        cmd.extend(['--boxid', args.boxid,
+                    '--worker_bind', curr_box.bind])
+        if args.ssl:
+            cmd.extend(['--ssl', args.ssl])
+
+        logger.warn('box {} launched as {} with {} workers'.format(
+            curr_box.boxid, curr_box.bind, args.workers))
+        self.supervisor = WorkerSupervisor(args.workers, cmd)
+        self.supervisor.start()
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(
+            signal.SIGTERM,
+            lambda: asyncio.ensure_future(self.stop_supervisor()))
         asyncio.ensure_future(self.wait_ttl(args.ttl))
 
+    async def stop_supervisor(self):
+        '''
+        deregister the box so clients stop routing to it,
+        then drain the workers and stop
+        '''
+        logger.info('supervisor stopping')
+        await get_box().deregister()
+        await self.supervisor.stop()
+        shutdown_executors(wait=False)
+        asyncio.get_event_loop().stop()
+
+    async def drain(self):
+        '''
+        stop accepting and finish pending requests, then stop
+        '''
+        logger.info('worker draining')
+        self.srv.close()
+        await self.srv.wait_closed()
+        await self.handler.shutdown(WORKER_DRAIN_SECS)
+        for h in self.mod_handlers:
+            h.shutdown()
+        shutdown_executors(wait=False)
+        asyncio.get_event_loop().stop()
+
     async def wait_ttl(self, ttl):
         await asyncio.sleep(ttl)
         logging.warn('box ttl expired, stop')
+        if self.supervisor:
+            await get_box().deregister()
+            await self.supervisor.stop()
         sys.exit(0)
 
     def shutdown(self):
@@ -78,5 +220,8 @@ class Handler(BaseHandler):
         for h in self.mod_handlers:
             h.shutdown()
         loop.run_until_complete(get_box().deregister())
+        if self.supervisor:
+            loop.run_until_complete(self.supervisor.stop())
+        shutdown_executors(wait=False)
         #loop.run_until_complete(
         #    self.handler.finish_connections())
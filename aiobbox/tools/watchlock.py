@@ -9,13 +9,14 @@ from aiobbox.cluster import get_cluster, get_sharedconfig, SimpleLock
 from aiobbox.exceptions import ETCDError
 from aiobbox.utils import guess_json, json_pp
 from aiobbox.handler import BaseHandler
+from aiobbox.tools import command_help
 
 parser = argparse.ArgumentParser(
     prog='bbox lock',
     description='acquire a lock and execute')
 
 class Handler(BaseHandler):
-    help = 'acquire a lock and execute'
+    help = command_help(__name__)
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -3,8 +3,8 @@ import string
 import ssl
 import os
 import json
-import netifaces
 import random
+from aiobbox.codec import json_dumps
 
 def guess_json(p):
     if p in ('null', 'true', 'false'):
@@ -23,8 +23,13 @@ def json_pp(v):
     return json.dumps(v, indent=2, sort_keys=True)
 
 def json_to_str(v):
+    # the output is stored in etcd and compared by prevValue,
+    # so it keeps the stdlib format whichever backend is used
     return json.dumps(v, sort_keys=True)
 
+def json_to_fast_str(v):
+    return json_dumps(v, sort_keys=True)
+
 def map_bytes_to_str(alist, encoding='utf-8'):
     return [v.decode(encoding) for v in alist]
 
@@ -70,6 +75,8 @@ def get_localbox_ipset():
     if _localbox_ipset is not None:
         return _localbox_ipset
 
+    # imported lazily to keep the startup of tools fast
+    import netifaces
     _localbox_ipset = set()
     for intf in netifaces.interfaces():
         for infos in netifaces.ifaddresses(intf).values():
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+'''
+measure the instrumentation cost per request of the box, e.g.
+
+    python benchmarks/metrics_overhead.py --ntimes 1000000
+'''
+import os
+import sys
+import time
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from aiobbox import stats
+
+def bench_empty(n):
+    for _ in range(n):
+        start_time = time.time()
+        elapsed = time.time() - start_time
+
+def bench_label_dict(n):
+    '''
+    the instrumentation before label interning, a label
+    string built and looked up per request
+    '''
+    values = defaultdict(int)
+    slow_values = defaultdict(int)
+    for _ in range(n):
+        start_time = time.time()
+        stats_name = '/{}/{}'.format('bench', 'echo')
+        values[stats_name] += 1
+        elapsed = time.time() - start_time
+        stats.rpc_latency.observe(stats_name, elapsed)
+        if elapsed > 1.0:
+            slow_values[stats_name] += 1
+
+def bench_endpoint_stats(n):
+    for _ in range(n):
+        start_time = time.time()
+        ep_stats = stats.get_endpoint_stats('bench', 'echo')
+        ep_stats.requests.inc()
+        elapsed = time.time() - start_time
+        ep_stats.latency.observe(elapsed)
+        if elapsed > 1.0:
+            ep_stats.slow.inc()
+
+def main():
+    parser = argparse.ArgumentParser(prog='metrics_overhead.py')
+    parser.add_argument(
+        '--ntimes',
+        type=int,
+        default=1000000,
+        help='iterate x times')
+    args = parser.parse_args()
+
+    timings = {}
+    for name, fn in (('empty', bench_empty),
+                     ('label dict', bench_label_dict),
+                     ('endpoint stats', bench_endpoint_stats)):
+        start_time = time.perf_counter()
+        fn(args.ntimes)
+        timings[name] = (time.perf_counter() - start_time) / args.ntimes
+    for name, t in timings.items():
+        print('{}: {:.0f}ns per request, {:.0f}ns over empty'.format(
+            name, t * 1e9, (t - timings['empty']) * 1e9))
+
+if __name__ == '__main__':
+    main()
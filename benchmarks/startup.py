@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+'''
+measure the wall time of bbox.py invocations, e.g.
+
+    python benchmarks/startup.py --ntimes 20 --cmd 'rpc -h'
+'''
+import os
+import sys
+import time
+import shlex
+import argparse
+import subprocess
+
+BBOX_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'bin', 'bbox.py')
+
+def main():
+    parser = argparse.ArgumentParser(prog='startup.py')
+    parser.add_argument(
+        '--ntimes',
+        type=int,
+        default=10,
+        help='iterate x times')
+    parser.add_argument(
+        '--cmd',
+        type=str,
+        default='-h',
+        help='arguments of bbox.py')
+    args = parser.parse_args()
+    bbox_args = shlex.split(args.cmd)
+
+    env = dict(os.environ)
+    root = os.path.join(os.path.dirname(BBOX_PY), '..')
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.abspath(root), env.get('PYTHONPATH', '')])
+
+    timings = []
+    for _ in range(args.ntimes):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, BBOX_PY] + bbox_args,
+                       stdout=subprocess.DEVNULL,
+                       env=env)
+        timings.append(time.perf_counter() - start_time)
+
+    timings.sort()
+    print('bbox.py {}: min {:.1f}ms, median {:.1f}ms, max {:.1f}ms'.format(
+        ' '.join(bbox_args),
+        timings[0] * 1000,
+        timings[len(timings) // 2] * 1000,
+        timings[-1] * 1000))
+
+if __name__ == '__main__':
+    main()
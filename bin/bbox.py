@@ -5,24 +5,16 @@ import asyncio
 from aiobbox.log import config_log
 from aiobbox.handler import BaseHandler
 from aiobbox.utils import import_module
+from aiobbox.tools import COMMANDS
 
 sys.path.append('.')
 
 config_log()
 
-sub_modules = [
-    ('init', 'aiobbox.tools.initprj'),
-    ('start', 'aiobbox.tools.startbox'),
-    ('httpd', 'aiobbox.tools.starthttpd'),
-    ('run', 'aiobbox.tools.runtask'),
-    ('rpc', 'aiobbox.tools.rpcclient'),
-    ('config', 'aiobbox.tools.clusterconfig'),
-    ('cluster', 'aiobbox.tools.clusterop'),
-    ('lock', 'aiobbox.tools.watchlock'),
-    ('printticket', 'aiobbox.tools.printticket'),
-    ('doc', 'aiobbox.tools.printdoc'),
-    ('metrics', 'aiobbox.tools.metrics'),
-    ]
+def selected_sub_cmd(argv):
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg
 
 def main():
     top_parser = argparse.ArgumentParser(
@@ -32,14 +24,17 @@ def main():
     sub_parsers = top_parser.add_subparsers(
         help='sub-command help')
 
-    for sub_cmd, mod_name in sub_modules:
+    selected = selected_sub_cmd(sys.argv[1:])
+    for sub_cmd, mod_name, help_msg in COMMANDS:
+        parser = sub_parsers.add_parser(sub_cmd, help=help_msg)
+        if sub_cmd != selected:
+            continue
+
         mod = import_module(mod_name)
 
         assert issubclass(mod.Handler, BaseHandler)
 
         handler = mod.Handler()
-        help_msg = getattr(handler, 'help', '')
-        parser = sub_parsers.add_parser(sub_cmd, help=help_msg)
         handler.add_arguments(parser)
         parser.set_defaults(handler=handler)
 
@@ -10,9 +10,12 @@ setup(name='aiobbox',
       scripts=['bin/bbox', 'bin/bbox.py', 'bin/bbox-gencert'],
       install_requires=[
           'aiohttp',
-          'aiochannel',
           'websockets',
           'aio_etcd',
           'netifaces'
-      ]
+      ],
+      extras_require={
+          'msgpack': ['msgpack'],
+          'cbor': ['cbor2']
+      }
 )
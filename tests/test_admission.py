@@ -0,0 +1,29 @@
+import asyncio
+
+from aiobbox import admission
+from aiobbox.server import Service
+from aiobbox.client import pool
+
+srv = Service()
+
+@srv.method('outer')
+async def outer(request, v):
+    r = await pool.request('test.admission', 'inner', v)
+    return r['result']
+
+@srv.method('inner')
+async def inner(request, v):
+    return v + 1
+
+srv.register('test.admission')
+
+def test_nested_local_call_shares_box_slot(monkeypatch):
+    gate = admission.Gate(limit=1)
+    monkeypatch.setattr(admission, '_box_gate', gate)
+
+    async def run():
+        return await asyncio.wait_for(
+            pool.request('test.admission', 'outer', 1), 3)
+    r = asyncio.run(run())
+    assert r['result'] == 2
+    assert gate.running == 0
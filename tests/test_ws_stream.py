@@ -0,0 +1,98 @@
+import json
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+from aiobbox import server
+from aiobbox.server import Service
+from aiobbox.cluster.box import get_box
+from aiobbox.cluster.cfg import get_sharedconfig
+
+srv = Service()
+
+@srv.method('gen')
+async def gen(request, n):
+    for i in range(n):
+        yield i
+
+@srv.method('echo')
+async def echo(request, v):
+    return v
+
+srv.register('test.wsstream')
+
+async def open_ws():
+    app = web.Application()
+    app.router.add_route('GET', '/bbox.ws', server.handle_ws)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    ws = await client.ws_connect('/bbox.ws', protocols=('bbox.json',))
+    return client, ws
+
+async def recv(ws):
+    msg = await asyncio.wait_for(ws.receive(), 5)
+    return json.loads(msg.data)
+
+def with_ws(monkeypatch, fn):
+    async def run():
+        client, ws = await open_ws()
+        try:
+            await fn(ws)
+        finally:
+            await ws.close()
+            await client.close()
+
+    monkeypatch.setattr(get_box(), 'boxid', 'testbox', raising=False)
+    config = get_sharedconfig()
+    config.set('box.testbox', 'ws_max_inflight', 2)
+    try:
+        asyncio.run(run())
+    finally:
+        config.delete_section('box.testbox')
+
+def test_streams_waiting_for_credit_free_slots(monkeypatch):
+    async def check(ws):
+        for req_id in ('s1', 's2'):
+            await ws.send_str(json.dumps({
+                'id': req_id, 'method': 'test.wsstream::gen',
+                'params': [2], 'credit': 1}))
+        chunks = [await recv(ws) for _ in range(2)]
+        assert sorted(c['id'] for c in chunks) == ['s1', 's2']
+
+        # both streams run out of credit, other calls still get in
+        await ws.send_str(json.dumps({
+            'id': 'e1', 'method': 'test.wsstream::echo',
+            'params': ['hi']}))
+        resp = await recv(ws)
+        assert resp == {'jsonrpc': '2.0', 'id': 'e1', 'result': 'hi'}
+
+        for req_id in ('s1', 's2'):
+            await ws.send_str(json.dumps({'id': req_id, 'credit': 2}))
+        msgs = [await recv(ws) for _ in range(4)]
+        assert sum(1 for m in msgs if 'chunk' in m) == 2
+        assert sum(1 for m in msgs if 'chunk' not in m) == 2
+    with_ws(monkeypatch, check)
+
+def test_invalid_frame_keeps_slots(monkeypatch):
+    async def check(ws):
+        for frame in ('"junk"', '1', '"junk"'):
+            await ws.send_str(frame)
+            resp = await recv(ws)
+            assert resp['error']['code'] == 'invalid request'
+        for i in range(3):
+            await ws.send_str(json.dumps({
+                'id': 'e{}'.format(i), 'method': 'test.wsstream::echo',
+                'params': [i]}))
+            resp = await recv(ws)
+            assert resp['result'] == i
+    with_ws(monkeypatch, check)
+
+def test_stream_only_on_request(monkeypatch):
+    async def check(ws):
+        await ws.send_str(json.dumps({
+            'id': 'g1', 'method': 'test.wsstream::gen',
+            'params': [3]}))
+        resp = await recv(ws)
+        assert resp['result'] == [0, 1, 2]
+    with_ws(monkeypatch, check)